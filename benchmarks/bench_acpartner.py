@@ -0,0 +1,232 @@
+"""
+Offline benchmark for the xiaomi_ac_radio platform.
+
+Stands up simulated gateways on 127.0.0.x and a stub Baidu TTS server,
+sets the platform up against them and measures startup, polling, channel
+skipping and announcement bursts, plus how long the event loop was blocked.
+
+    python benchmarks/bench_acpartner.py --devices 12 --latency 0.02 --loss 0.01
+"""
+import argparse
+import asyncio
+import inspect
+import os
+import shutil
+import sys
+import tempfile
+import time
+import types
+
+import aiohttp
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from homeassistant.components.ffmpeg import DATA_FFMPEG  # noqa: E402
+from homeassistant.core import HomeAssistant  # noqa: E402
+from homeassistant.const import EVENT_HOMEASSISTANT_CLOSE  # noqa: E402
+
+from custom_components.miio_acpartner import (  # noqa: E402
+    DATA_POLLER, SCAN_INTERVAL, RadioPoller)
+from custom_components.xiaomi_ac_radio import tts  # noqa: E402
+from custom_components.xiaomi_ac_radio import miio_acpartner as platform  # noqa: E402
+from custom_components.xiaomi_ac_radio.server import (  # noqa: E402
+    DATA_CLIP_STORE, ClipStore, ClipView)
+from simulator import SimulatedGateway, TTSStub  # noqa: E402
+
+
+
+class LoopMonitor:
+    """Measure event loop lag by sleeping in short steps."""
+
+    def __init__(self, interval=0.01):
+        self._interval = interval
+        self._task = None
+        self.lags = []
+
+    async def _run(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self._interval)
+            self.lags.append(max(0.0, time.monotonic() - started - self._interval))
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+def summary(samples):
+    if not samples:
+        return "n=0"
+    ordered = sorted(samples)
+
+    def pct(p):
+        return ordered[min(len(ordered) - 1, len(ordered) * p // 100)] * 1000
+    return "n=%d p50=%.1fms p90=%.1fms p99=%.1fms max=%.1fms" % (
+        len(ordered), pct(50), pct(90), pct(99), ordered[-1] * 1000)
+
+
+async def timed(coro, samples):
+    started = time.monotonic()
+    result = await coro
+    samples.append(time.monotonic() - started)
+    return result
+
+
+def create_hass(config_dir):
+    if "config_dir" in inspect.signature(HomeAssistant.__init__).parameters:
+        hass = HomeAssistant(config_dir)
+    else:
+        hass = HomeAssistant()
+        hass.config.config_dir = config_dir
+    return hass
+
+
+async def start_clip_server(hass):
+    store = hass.data[DATA_CLIP_STORE] = ClipStore(64 * 1024 * 1024)
+    view = ClipView(hass, store)
+
+    async def _get(request):
+        return await view.get(request, request.match_info["clip"])
+    app = web.Application()
+    app.router.add_get("/api/xiaomi_ac_radio/clip/{clip}", _get)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, "http://127.0.0.1:%d" % runner.addresses[0][1]
+
+
+async def run(args):
+    config_dir = tempfile.mkdtemp(prefix="acpartner_bench_")
+    hass = create_hass(config_dir)
+    hass.data[DATA_FFMPEG] = types.SimpleNamespace(binary=args.ffmpeg)
+    hass.data[DATA_POLLER] = RadioPoller(hass, SCAN_INTERVAL)
+    stub = TTSStub(args.tts_latency)
+    await stub.async_start()
+    tts.TOKEN_INTERFACE = stub.url + "/oauth/2.0/token"
+    tts.TEXT2AUDIO_INTERFACE = stub.url + "/text2audio"
+    clip_runner, base_url = await start_clip_server(hass)
+    session = aiohttp.ClientSession()
+    gateways = []
+    for index in range(args.devices):
+        # distinct tokens, the platform remembers device identities per token
+        gateway = SimulatedGateway("127.0.0.%d" % (index + 2), "%032x" % (index + 1), args.latency,
+                                   args.jitter, args.loss, args.channels, session=session)
+        await gateway.async_start()
+        gateways.append(gateway)
+
+    monitor = LoopMonitor()
+    monitor.start()
+    results = {}
+
+    # startup: platform setup + background inventory load
+    entities = []
+    setup, inventory = [], []
+
+    async def _setup(gateway):
+        added = []
+        config = platform.PLATFORM_SCHEMA({
+            "platform": "xiaomi_ac_radio",
+            "name": "bench_%s" % gateway.host.replace(".", "_"),
+            "host": gateway.host,
+            "token": gateway.token.hex(),
+            "api_key": "bench",
+            "secret_key": "bench",
+            "base_url": base_url,
+            "base_path": config_dir,
+            "timeout": args.timeout,
+            "tts_engines": [args.engine],
+        })
+        await timed(platform.async_setup_platform(hass, config, added.extend), setup)
+        entity = added[0]
+        entity.hass = hass
+        entity.entity_id = "miio_acpartner.%s" % entity.name
+        await entity._inventory.async_load()
+        await entity._slots.async_load()
+        hass.data[DATA_POLLER].async_add(entity)
+        await timed(entity.async_refresh_inventory(), inventory)
+        entities.append(entity)
+    started = time.monotonic()
+    await asyncio.gather(*(_setup(gateway) for gateway in gateways))
+    results["startup (all devices)"] = [time.monotonic() - started]
+    results["setup_platform"] = setup
+    results["inventory refresh"] = inventory
+
+    # polling: full coordinator rounds
+    polls = []
+    for _ in range(args.polls):
+        await timed(hass.data[DATA_POLLER]._async_poll(), polls)
+    results["poll round"] = polls
+
+    # channel skipping
+    skips = []
+    for _ in range(args.skips):
+        await asyncio.gather(*(timed(entity.async_next_radio(), skips) for entity in entities))
+    results["next_radio"] = skips
+
+    # announcement bursts: a few recurring phrases, concurrently on every device
+    phrases = ["door open %d" % i for i in range(args.phrases)]
+    first, repeat = [], []
+    for round_index in range(args.burst):
+        samples = first if round_index == 0 else repeat
+        await asyncio.gather(*(
+            timed(entity.async_play_tts(phrases[(round_index + i) % len(phrases)]), samples)
+            for i, entity in enumerate(entities)))
+    results["play_tts (first round)"] = first
+    results["play_tts (repeat rounds)"] = repeat
+
+    await monitor.stop()
+    results["event loop lag"] = monitor.lags
+
+    print("devices=%d latency=%.0fms loss=%.1f%% engine=%s" % (
+        args.devices, args.latency * 1000, args.loss * 100, args.engine))
+    for name, samples in results.items():
+        print("  %-26s %s" % (name, summary(samples)))
+    udp = {}
+    for gateway in gateways:
+        for method, count in gateway.requests.items():
+            udp[method] = udp.get(method, 0) + count
+    print("  udp requests: %s" % ", ".join("%s=%d" % item for item in sorted(udp.items())))
+    print("  tts stub calls: %s" % stub.calls)
+
+    for entity in entities:
+        await entity.async_will_remove_from_hass()
+    for gateway in gateways:
+        gateway.close()
+    await session.close()
+    # closes the shared Home Assistant session the platform fetched through
+    hass.bus.async_fire(EVENT_HOMEASSISTANT_CLOSE)
+    await hass.async_block_till_done()
+    await clip_runner.cleanup()
+    await stub.async_stop()
+    shutil.rmtree(config_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--devices", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.01, help="gateway reply latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.005)
+    parser.add_argument("--loss", type=float, default=0.0, help="packet loss ratio 0..1")
+    parser.add_argument("--timeout", type=int, default=1, help="miio request timeout")
+    parser.add_argument("--channels", type=int, default=30)
+    parser.add_argument("--polls", type=int, default=10)
+    parser.add_argument("--skips", type=int, default=10)
+    parser.add_argument("--burst", type=int, default=5, help="announcement rounds")
+    parser.add_argument("--phrases", type=int, default=3)
+    parser.add_argument("--engine", default="baidu", choices=tts.TTS_ENGINES)
+    parser.add_argument("--tts-latency", type=float, default=0.05)
+    parser.add_argument("--ffmpeg", default="ffmpeg")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""
+Simulated AC partner and Baidu TTS stub for the offline benchmark.
+
+SimulatedGateway answers the miio commands used by xiaomi_ac_radio over
+real UDP (with configurable latency and packet loss); TTSStub serves the
+Baidu token and text2audio endpoints from a local aiohttp server.
+"""
+import asyncio
+import datetime
+import logging
+import random
+import struct
+
+from aiohttp import web
+
+from miio.protocol import Message
+
+from custom_components.xiaomi_ac_radio.tts import FakeTTS
+
+_LOGGER = logging.getLogger(__name__)
+
+MIIO_PORT = 54321
+SYSTEM_RINGTONES = {0: [0, 1, 2, 3], 1: [10, 11, 12], 2: [20, 21]}
+
+
+class SimulatedGateway(asyncio.DatagramProtocol):
+    def __init__(self, host, token, latency=0.01, jitter=0.005, loss=0.0,
+                 channels=30, free_space=4 * 1024 * 1024, session=None):
+        self.host = host
+        self.token = bytes.fromhex(token)
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.device_id = random.getrandbits(32).to_bytes(4, "big")
+        self.channels = [1000 + i for i in range(channels)]
+        self.program = self.channels[0]
+        self.volume = 50
+        self.running = False
+        self.free_space = free_space
+        self.music = {}
+        self.progress = {}
+        self.played = []
+        self.requests = {}
+        self._session = session
+        self._transport = None
+        self._loop = None
+
+    async def async_start(self):
+        self._loop = asyncio.get_running_loop()
+        self._transport, _ = await self._loop.create_datagram_endpoint(
+            lambda: self, local_addr=(self.host, MIIO_PORT))
+
+    def close(self):
+        if self._transport is not None:
+            self._transport.close()
+
+    def _reply(self, data, addr):
+        delay = max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+        self._loop.call_later(delay, self._transport.sendto, data, addr)
+
+    def datagram_received(self, data, addr):
+        if random.random() < self.loss:
+            return
+        if len(data) == 32:
+            ts = int(datetime.datetime.now().timestamp())
+            hello = struct.pack(">HHI4sI", 0x2131, 32, 0, self.device_id, ts) + self.token
+            self._reply(hello, addr)
+            return
+        request = Message.parse(data, token=self.token).data.value
+        method = request.get("method")
+        self.requests[method] = self.requests.get(method, 0) + 1
+        try:
+            payload = {"id": request["id"], "result": self.handle(method, request.get("params"))}
+        except KeyError:
+            payload = {"id": request["id"], "error": {"code": -1, "message": "unknown method"}}
+        header = {"length": 0, "unknown": 0, "device_id": self.device_id,
+                  "ts": datetime.datetime.now()}
+        msg = {"data": {"value": payload}, "header": {"value": header}, "checksum": 0}
+        self._reply(Message.build(msg, token=self.token), addr)
+
+    def handle(self, method, params):
+        if method == "miIO.info":
+            return {"model": "lumi.acpartner.v3", "mac": "SI:MU:LA:TE:%02X:%02X" % tuple(self.device_id[2:]),
+                    "fw_ver": "1.4.1_sim", "hw_ver": "sim", "token": self.token.hex(),
+                    "ap": {"ssid": "sim", "bssid": "00:00:00:00:00:00", "rssi": -40},
+                    "netif": {"localIp": self.host, "mask": "255.0.0.0", "gw": "127.0.0.1"}}
+        if method == "get_prop_fm":
+            return {"current_program": self.program, "current_volume": self.volume,
+                    "current_status": "run" if self.running else "pause"}
+        if method == "get_channels":
+            start = params.get("start", 0)
+            chs = [{"id": ch, "type": 0, "url": ""} for ch in self.channels[start:start + 10]]
+            return {"start": start, "chs": chs} if chs else {"start": start}
+        if method == "play_fm":
+            self.running = params[0] == "on"
+            return ["ok"]
+        if method == "volume_ctrl_fm":
+            self.volume = int(params[0])
+            return ["ok"]
+        if method == "play_specify_fm":
+            self.program = params["id"]
+            self.running = True
+            return ["ok"]
+        if method == "get_music_info":
+            if params[0] == 3:
+                mids = sorted(self.music)
+            else:
+                mids = SYSTEM_RINGTONES.get(params[0], [])
+            return {"list": [{"mid": mid, "time": 3} for mid in mids]}
+        if method == "get_music_free_space":
+            return self.free_space - sum(self.music.values())
+        if method == "delete_user_music":
+            self.music.pop(str(params[0]), None)
+            self.progress.pop(str(params[0]), None)
+            return ["ok"]
+        if method == "download_user_music":
+            mid, url = str(params[0]), params[1]
+            self.progress[mid] = 0
+            self._loop.create_task(self._async_download(mid, url))
+            return ["ok"]
+        if method == "get_download_progress":
+            return ["%s:%d" % (mid, pct) for mid, pct in self.progress.items()]
+        if method in ("play_music", "play_music_new"):
+            self.played.append((str(params[0]), self._loop.time()))
+            return ["ok"]
+        raise KeyError(method)
+
+    async def _async_download(self, mid, url):
+        size = 0
+        try:
+            async with self._session.get(url) as resp:
+                total = int(resp.headers.get("Content-Length", 0)) or 1
+                async for chunk in resp.content.iter_chunked(4096):
+                    size += len(chunk)
+                    self.progress[mid] = min(99, size * 100 // total)
+        except Exception as ex:  # pylint: disable=broad-except
+            _LOGGER.warning("%s: download %s failed: %s", self.host, url, ex)
+            self.progress[mid] = -1
+            return
+        self.music[mid] = size
+        self.progress[mid] = 100
+
+
+class TTSStub:
+    def __init__(self, latency=0.05):
+        self.latency = latency
+        self.calls = {"token": 0, "text2audio": 0}
+        self.url = None
+        self._engine = FakeTTS()
+        self._runner = None
+
+    async def _token(self, request):
+        self.calls["token"] += 1
+        await asyncio.sleep(self.latency)
+        return web.json_response({"access_token": "bench", "expires_in": 2592000})
+
+    async def _text2audio(self, request):
+        self.calls["text2audio"] += 1
+        await asyncio.sleep(self.latency)
+        return web.Response(body=self._engine.render(request.query.get("tex", "")),
+                            content_type="audio/wav")
+
+    async def async_start(self, host="127.0.0.1", port=0):
+        app = web.Application()
+        app.router.add_get("/oauth/2.0/token", self._token)
+        app.router.add_get("/text2audio", self._text2audio)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.url = "http://%s:%d" % (host, port)
+
+    async def async_stop(self):
+        await self._runner.cleanup()
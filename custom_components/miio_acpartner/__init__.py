@@ -8,12 +8,14 @@ import asyncio
 from datetime import timedelta
 import functools as ft
 import logging
+import time
 
 import voluptuous as vol
 
 from homeassistant.loader import bind_hass
 from homeassistant.helpers.entity_component import EntityComponent
 from homeassistant.helpers.entity import ToggleEntity
+from homeassistant.helpers.event import async_track_time_interval
 import homeassistant.helpers.config_validation as cv
 from homeassistant.helpers.config_validation import (  # noqa
     make_entity_service_schema,
@@ -30,6 +32,8 @@ _LOGGER = logging.getLogger(__name__)
 
 DOMAIN = 'miio_acpartner'
 SCAN_INTERVAL = timedelta(seconds=30)
+DATA_POLLER = DOMAIN + '_poller'
+REFRESH_DELAY = 1.0
 
 GROUP_NAME_ALL_RADIOS = 'all radios'
 ENTITY_ID_ALL_RADIOS = group.ENTITY_ID_FORMAT.format('all_radios')
@@ -40,6 +44,19 @@ ATTR_RINGTONEID = 'ringtone_id'
 ATTR_VOLUME = 'volume'
 ATTR_MESSAGE = "message"
 ATTR_URL = "url"
+ATTR_POLICY = "policy"
+ATTR_MESSAGES = "messages"
+ATTR_URLS = "urls"
+ATTR_PRELOAD = "preload"
+ATTR_PATH = "path"
+ATTR_CONCURRENCY = "concurrency"
+ATTR_PRUNE = "prune"
+
+POLICY_QUEUE = 'queue'
+POLICY_REPLACE = 'replace'
+POLICY_DROP = 'drop'
+POLICY_PRIORITY = 'priority'
+ANNOUNCE_POLICIES = [POLICY_QUEUE, POLICY_REPLACE, POLICY_DROP, POLICY_PRIORITY]
 
 ENTITY_ID_FORMAT = DOMAIN + '.{}'
 MIN_TIME_BETWEEN_SCANS = timedelta(seconds=10)
@@ -52,6 +69,13 @@ SERVICE_PLAY_RINGTONE = 'play_ringtone'
 SERVICE_PLAY_TTS = 'play_tts'
 SERVICE_PLAY_VOD = 'play_vod'
 SERVICE_SYNC = 'sync'
+SERVICE_BROADCAST = 'broadcast'
+SERVICE_PRERENDER = 'prerender'
+SERVICE_SYNC_RINGTONES = 'sync_ringtones'
+
+EVENT_BROADCAST = DOMAIN + '_broadcast'
+EVENT_RINGTONES_SYNCED = DOMAIN + '_ringtones_synced'
+BROADCAST_TIMEOUT = 60
 
 DEFAULT_NUM_REPEATS = 1
 DEFAULT_DELAY_SECS = 0.4
@@ -78,14 +102,34 @@ RADIO_SERVICE_PLAY_RINGTONE_SCHEMA = make_entity_service_schema({
 
 RADIO_SERVICE_PLAY_TTS_SCHEMA = make_entity_service_schema({
     vol.Required(ATTR_MESSAGE): cv.string,
-    vol.Optional(ATTR_VOLUME): cv.string
+    vol.Optional(ATTR_VOLUME): cv.string,
+    vol.Optional(ATTR_POLICY): vol.In(ANNOUNCE_POLICIES)
 })
 
 RADIO_SERVICE_PLAY_VOD_SCHEMA = make_entity_service_schema({
     vol.Required(ATTR_URL): cv.string,
-    vol.Optional(ATTR_VOLUME): cv.string
+    vol.Optional(ATTR_VOLUME): cv.string,
+    vol.Optional(ATTR_POLICY): vol.In(ANNOUNCE_POLICIES)
 })
 
+RADIO_SERVICE_PRERENDER_SCHEMA = vol.All(make_entity_service_schema({
+    vol.Optional(ATTR_MESSAGES): vol.All(cv.ensure_list, [cv.string]),
+    vol.Optional(ATTR_URLS): vol.All(cv.ensure_list, [cv.string]),
+    vol.Optional(ATTR_PRELOAD, default=False): cv.boolean
+}), cv.has_at_least_one_key(ATTR_MESSAGES, ATTR_URLS))
+
+RADIO_SERVICE_SYNC_RINGTONES_SCHEMA = make_entity_service_schema({
+    vol.Required(ATTR_PATH): cv.isdir,
+    vol.Optional(ATTR_CONCURRENCY, default=2): vol.All(vol.Coerce(int), vol.Range(min=1, max=10)),
+    vol.Optional(ATTR_PRUNE, default=False): cv.boolean
+})
+
+RADIO_SERVICE_BROADCAST_SCHEMA = vol.All(make_entity_service_schema({
+    vol.Exclusive(ATTR_MESSAGE, 'source'): cv.string,
+    vol.Exclusive(ATTR_URL, 'source'): cv.string,
+    vol.Optional(ATTR_VOLUME): cv.string
+}), cv.has_at_least_one_key(ATTR_MESSAGE, ATTR_URL))
+
 @bind_hass
 def is_on(hass, entity_id=None):
     entity_id = entity_id or ENTITY_ID_ALL_RADIOS
@@ -93,6 +137,7 @@ def is_on(hass, entity_id=None):
 
 @asyncio.coroutine
 def async_setup(hass, config):
+    hass.data[DATA_POLLER] = RadioPoller(hass, SCAN_INTERVAL)
     component = hass.data[DOMAIN] = EntityComponent(
         _LOGGER, DOMAIN, hass, SCAN_INTERVAL
     )
@@ -128,9 +173,86 @@ def async_setup(hass, config):
     component.async_register_entity_service(
         SERVICE_PLAY_VOD, RADIO_SERVICE_PLAY_VOD_SCHEMA, "async_play_vod"
     )
+    component.async_register_entity_service(
+        SERVICE_SYNC, ENTITY_SERVICE_SCHEMA, "async_sync"
+    )
+    component.async_register_entity_service(
+        SERVICE_PRERENDER, RADIO_SERVICE_PRERENDER_SCHEMA, "async_prerender"
+    )
+    component.async_register_entity_service(
+        SERVICE_SYNC_RINGTONES, RADIO_SERVICE_SYNC_RINGTONES_SCHEMA, "async_sync_ringtones"
+    )
+
+    async def async_handle_broadcast(call):
+        entities = await component.async_extract_from_service(call)
+        await async_broadcast(hass, entities, call.data.get(ATTR_MESSAGE),
+                              call.data.get(ATTR_URL), call.data.get(ATTR_VOLUME))
+    hass.services.async_register(
+        DOMAIN, SERVICE_BROADCAST, async_handle_broadcast,
+        schema=RADIO_SERVICE_BROADCAST_SCHEMA)
     return True
 
 
+async def async_broadcast(hass, entities, message=None, url=None, volume=None):
+    """Render a clip once and start it on every entity at the same time."""
+    skipped = [entity.entity_id for entity in entities if not entity.available]
+    if skipped:
+        _LOGGER.warning("Skip unavailable entities for broadcast: %s", skipped)
+    entities = [entity for entity in entities if entity.available]
+    if not entities:
+        return {}
+    started = time.monotonic()
+    # renders write to their own temp file, so this can run beside
+    # whatever the source entity is announcing
+    source = entities[0]
+    if message is not None:
+        clip = await source.async_render_tts(message)
+    else:
+        clip = await source.async_render_vod(url)
+    if clip is None:
+        _LOGGER.error("Render broadcast clip failed.")
+        return {}
+    rendered = time.monotonic() - started
+    ready = asyncio.Event()
+    waiting = {entity.entity_id for entity in entities}
+    latency = {}
+
+    def _arrived(entity):
+        waiting.discard(entity.entity_id)
+        if not waiting:
+            ready.set()
+
+    async def _job(entity):
+        try:
+            mid = await entity.async_prepare_clip(clip)
+        finally:
+            _arrived(entity)
+        if mid is None:
+            return False
+        try:
+            await asyncio.wait_for(ready.wait(), BROADCAST_TIMEOUT)
+        except asyncio.TimeoutError:
+            _LOGGER.warning("%s: start broadcast without waiting for the others.", entity.name)
+        res = await entity.async_start_clip(mid, volume)
+        latency[entity.entity_id] = round(time.monotonic() - started, 3)
+        return res
+
+    async def _run(entity):
+        try:
+            await entity.async_announce(ft.partial(_job, entity))
+        finally:
+            _arrived(entity)
+
+    await asyncio.gather(*(_run(entity) for entity in entities))
+    hass.bus.async_fire(EVENT_BROADCAST, {
+        ATTR_MESSAGE: message,
+        ATTR_URL: url,
+        'render': round(rendered, 3),
+        'latency': latency,
+    })
+    return latency
+
+
 async def async_setup_entry(hass, entry):
     """Set up a config entry."""
     return await hass.data[DOMAIN].async_setup_entry(entry)
@@ -173,3 +295,96 @@ class RadioDevice(ToggleEntity):
         raise NotImplementedError()
     def async_play_vod(self, message, **kwargs):
         return self.hass.async_add_job(ft.partial(self.play_vod, message, **kwargs))
+
+    def async_render_tts(self, message, trace=None):
+        raise NotImplementedError()
+    def async_render_vod(self, url, trace=None):
+        raise NotImplementedError()
+    def async_prepare_clip(self, clip, trace=None):
+        raise NotImplementedError()
+    def async_start_clip(self, mid, volume=None, trace=None):
+        raise NotImplementedError()
+    def async_announce(self, job, policy=POLICY_QUEUE):
+        raise NotImplementedError()
+
+    def prerender(self, **kwargs):
+        raise NotImplementedError()
+    def async_prerender(self, **kwargs):
+        return self.hass.async_add_job(ft.partial(self.prerender, **kwargs))
+
+    def sync(self, **kwargs):
+        raise NotImplementedError()
+    def async_sync(self, **kwargs):
+        return self.hass.async_add_job(ft.partial(self.sync, **kwargs))
+
+    def sync_ringtones(self, **kwargs):
+        raise NotImplementedError()
+    def async_sync_ringtones(self, **kwargs):
+        return self.hass.async_add_job(ft.partial(self.sync_ringtones, **kwargs))
+
+
+class RadioPoller:
+    """Poll every registered radio concurrently and coalesce refreshes."""
+
+    def __init__(self, hass, interval):
+        self._hass = hass
+        self._interval = interval
+        # keyed by entity_id, Entity defines __eq__ and so can't be hashed
+        self._entities = {}
+        self._refreshing = {}
+        self._rerun = set()
+        self._delayed = {}
+        self._unsub = None
+
+    def async_add(self, entity):
+        self._entities[entity.entity_id] = entity
+        if self._unsub is None:
+            self._unsub = async_track_time_interval(
+                self._hass, self._async_poll, self._interval)
+
+    def async_remove(self, entity):
+        self._entities.pop(entity.entity_id, None)
+        handle = self._delayed.pop(entity.entity_id, None)
+        if handle is not None:
+            handle.cancel()
+        if not self._entities and self._unsub is not None:
+            self._unsub()
+            self._unsub = None
+
+    async def _async_poll(self, now=None):
+        entities = list(self._entities.values())
+        if entities:
+            await asyncio.gather(*(self.async_refresh(entity)
+                                   for entity in entities))
+
+    async def _async_run(self, entity):
+        try:
+            while True:
+                self._rerun.discard(entity.entity_id)
+                try:
+                    await entity.async_update_state()
+                except Exception:  # pylint: disable=broad-except
+                    _LOGGER.exception("Update %s failed", entity.name)
+                if entity.entity_id not in self._rerun:
+                    break
+        finally:
+            self._refreshing.pop(entity.entity_id, None)
+
+    async def async_refresh(self, entity, rerun=False):
+        task = self._refreshing.get(entity.entity_id)
+        if task is None:
+            task = self._refreshing[entity.entity_id] = self._hass.async_create_task(
+                self._async_run(entity))
+        elif rerun:
+            self._rerun.add(entity.entity_id)
+        await asyncio.shield(task)
+
+    def async_request_refresh(self, entity, delay=REFRESH_DELAY):
+        handle = self._delayed.pop(entity.entity_id, None)
+        if handle is not None:
+            handle.cancel()
+
+        def _refresh():
+            self._delayed.pop(entity.entity_id, None)
+            self._hass.async_create_task(self.async_refresh(entity, True))
+        self._delayed[entity.entity_id] = self._hass.loop.call_later(delay, _refresh)
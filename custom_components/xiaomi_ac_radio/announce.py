@@ -0,0 +1,77 @@
+"""
+Per-gateway announcement queue for the Xiaomi Gateway Radio.
+
+TTS and VOD requests for one gateway run one at a time so they never
+clobber each other's files or user-music downloads.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+
+from custom_components.miio_acpartner import (
+    POLICY_QUEUE, POLICY_REPLACE, POLICY_DROP, POLICY_PRIORITY)
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class AnnouncementQueue:
+    def __init__(self, hass, name):
+        self._hass = hass
+        self._name = name
+        self._pending = deque()
+        self._current = None
+        self._worker = None
+        self.last_wait = 0.0
+
+    @property
+    def length(self):
+        return len(self._pending)
+
+    @property
+    def busy(self):
+        return self._current is not None or bool(self._pending)
+
+    def _cancel_all(self):
+        while self._pending:
+            _, future, _ = self._pending.popleft()
+            if not future.done():
+                future.set_result(False)
+        if self._current is not None:
+            self._current.cancel()
+
+    async def async_submit(self, job, policy=POLICY_QUEUE):
+        if policy == POLICY_DROP and self.busy:
+            _LOGGER.warning("%s is busy, announcement dropped.", self._name)
+            return False
+        if policy == POLICY_REPLACE:
+            self._cancel_all()
+        future = self._hass.loop.create_future()
+        item = (job, future, time.monotonic())
+        if policy == POLICY_PRIORITY:
+            self._pending.appendleft(item)
+        else:
+            self._pending.append(item)
+        if self._worker is None or self._worker.done():
+            self._worker = self._hass.loop.create_task(self._async_run())
+        return await future
+
+    async def _async_run(self):
+        while self._pending:
+            job, future, queued = self._pending.popleft()
+            if future.done():
+                continue
+            self.last_wait = time.monotonic() - queued
+            self._current = self._hass.loop.create_task(job())
+            try:
+                result = await self._current
+            except asyncio.CancelledError:
+                _LOGGER.info("%s: announcement replaced.", self._name)
+                result = False
+            except Exception as ex:  # pylint: disable=broad-except
+                _LOGGER.error(ex)
+                result = False
+            finally:
+                self._current = None
+            if not future.done():
+                future.set_result(result)
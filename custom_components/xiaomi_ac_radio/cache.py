@@ -0,0 +1,180 @@
+"""
+Content-addressed audio cache for the Xiaomi Gateway Radio.
+
+Finished AAC clips are kept on disk by content hash, from where the clip
+view in server.py serves them to the gateway, and are evicted in
+least-recently-used order once the entry or byte limit is reached.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+_LOGGER = logging.getLogger(__name__)
+
+DATA_AUDIO_CACHES = 'xiaomi_ac_radio_audio_caches'
+DATA_RENDERS = 'xiaomi_ac_radio_renders'
+INDEX_FILE = 'index.json'
+AUDIO_EXT = '.aac'
+# a hit only reorders the LRU, it is written out at most this often
+SAVE_DELAY = 60
+
+
+def cache_key(*parts):
+    return hashlib.sha1("|".join(str(p) for p in parts).encode('utf-8')).hexdigest()
+
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+async def async_shared(hass, key, factory):
+    """Await factory() once for every concurrent caller with the same key.
+
+    The shared task is only cancelled once all of its callers are.
+    """
+    renders = hass.data.setdefault(DATA_RENDERS, {})
+    render = renders.get(key)
+    if render is None:
+        render = renders[key] = {'task': hass.async_create_task(factory()), 'waiters': 0}
+
+        def _done(task):
+            if renders.get(key) is render:
+                del renders[key]
+        render['task'].add_done_callback(_done)
+    render['waiters'] += 1
+    try:
+        return await asyncio.shield(render['task'])
+    except asyncio.CancelledError:
+        if render['waiters'] == 1:
+            render['task'].cancel()
+        raise
+    finally:
+        render['waiters'] -= 1
+
+
+def get_audio_cache(hass, path, max_entries, max_bytes):
+    caches = hass.data.setdefault(DATA_AUDIO_CACHES, {})
+    if path not in caches:
+        caches[path] = AudioCache(path, max_entries, max_bytes)
+    return caches[path]
+
+
+class AudioCache:
+    def __init__(self, path, max_entries=100, max_bytes=50 * 1024 * 1024):
+        self._path = path
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict()
+        # encoded length in seconds, as reported by ffmpeg
+        self._durations = {}
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._dirty = False
+        self._saved = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def entries(self):
+        return len(self._entries)
+
+    @property
+    def size_bytes(self):
+        return sum(self._entries.values())
+
+    def file_path(self, key):
+        return os.path.join(self._path, key + AUDIO_EXT)
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        os.makedirs(self._path, exist_ok=True)
+        try:
+            with open(os.path.join(self._path, INDEX_FILE), "r") as fp:
+                index = json.load(fp)
+        except (OSError, ValueError):
+            index = []
+        for key, size, *duration in index:
+            if os.path.exists(self.file_path(key)):
+                self._entries[key] = size
+                if duration:
+                    self._durations[key] = duration[0]
+
+    def _save(self):
+        self._dirty = False
+        self._saved = time.monotonic()
+        try:
+            with open(os.path.join(self._path, INDEX_FILE), "w") as fp:
+                json.dump([[key, size, self._durations.get(key)]
+                           for key, size in self._entries.items()], fp)
+        except OSError as ex:
+            _LOGGER.warning("Save audio cache index failed: %s", ex)
+
+    def _evict(self):
+        while len(self._entries) > 1 and (
+                len(self._entries) > self._max_entries
+                or self.size_bytes > self._max_bytes):
+            key, _ = self._entries.popitem(last=False)
+            self._durations.pop(key, None)
+            remove_file(self.file_path(key))
+            _LOGGER.debug("Evict audio cache entry %s", key)
+
+    def get(self, key):
+        with self._lock:
+            self._load()
+            if key in self._entries and os.path.exists(self.file_path(key)):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self._dirty = True
+                if time.monotonic() - self._saved > SAVE_DELAY:
+                    self._save()
+                return self.file_path(key)
+            self._entries.pop(key, None)
+            self._durations.pop(key, None)
+            self.misses += 1
+            return None
+
+    def flush(self):
+        """Write out the LRU order of hits that were not saved yet."""
+        with self._lock:
+            if self._dirty:
+                self._save()
+
+    def duration(self, key):
+        """Return the encoded length of key in seconds, None if it is unknown."""
+        return self._durations.get(key)
+
+    def put(self, key, source, duration=None):
+        with self._lock:
+            self._load()
+            target = self.file_path(key)
+            shutil.move(source, target)
+            self._entries[key] = os.path.getsize(target)
+            if duration is not None:
+                self._durations[key] = duration
+            self._entries.move_to_end(key)
+            self._evict()
+            self._save()
+            return target
@@ -0,0 +1,75 @@
+"""
+Latest-wins command scheduling for the Xiaomi Gateway Radio.
+
+Commands of the same kind (volume, channel, power) that pile up while an
+earlier one is being sent collapse into the latest value, and sends are
+spaced out so a burst of slider or button events never turns into a
+backlog of stale UDP commands.
+"""
+import asyncio
+import logging
+
+from miio import DeviceException
+
+_LOGGER = logging.getLogger(__name__)
+
+KIND_POWER = 'power'
+KIND_VOLUME = 'volume'
+KIND_CHANNEL = 'channel'
+MIN_INTERVAL = 0.2
+
+
+class CommandScheduler:
+    def __init__(self, hass, device, name, interval=MIN_INTERVAL, on_idle=None):
+        self._hass = hass
+        self._device = device
+        self._name = name
+        self._interval = interval
+        self._on_idle = on_idle
+        self._pending = {}
+        self._worker = None
+        self.sent = 0
+        self.coalesced = 0
+
+    @property
+    def length(self):
+        return len(self._pending)
+
+    async def async_submit(self, kind, command, parameters):
+        """Send command, replacing a pending one of the same kind; return its success."""
+        future = self._hass.loop.create_future()
+        pending = self._pending.get(kind)
+        if pending is not None:
+            self.coalesced += 1
+            waiters = pending[2]
+            # dict order is kept, the kind keeps its place in line
+            self._pending[kind] = (command, parameters, waiters)
+            waiters.append(future)
+        else:
+            self._pending[kind] = (command, parameters, [future])
+        if self._worker is None or self._worker.done():
+            self._worker = self._hass.async_create_task(self._async_run())
+        return await asyncio.shield(future)
+
+    async def _async_run(self):
+        loop = self._hass.loop
+        while self._pending:
+            kind = next(iter(self._pending))
+            command, parameters, waiters = self._pending.pop(kind)
+            started = loop.time()
+            result = False
+            try:
+                await self._device.async_send(command, parameters)
+                result = True
+            except DeviceException as error:
+                _LOGGER.error("%s: %s failed: %s", self._name, command, error)
+            except Exception:  # pylint: disable=broad-except
+                _LOGGER.exception("%s: %s failed", self._name, command)
+            finally:
+                self.sent += 1
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_result(result)
+            await asyncio.sleep(max(0, self._interval - (loop.time() - started)))
+        if self._on_idle is not None:
+            self._on_idle()
@@ -0,0 +1,119 @@
+"""
+Local network discovery of Xiaomi Gateway Radios.
+
+One miio hello broadcast collects every responder within a short window;
+configured tokens are matched to responders by the device id remembered
+from an earlier match, or else verified against all unclaimed responders
+in parallel. All entities share one scan, and a gateway that stopped
+answering can be looked up again after DHCP gave it a new address.
+"""
+import asyncio
+import logging
+import time
+
+from miio import DeviceException
+
+from homeassistant.helpers.storage import Store
+
+from custom_components.xiaomi_ac_radio.protocol import (
+    AsyncMiioDevice, HELLO, MIIO_PORT)
+
+_LOGGER = logging.getLogger(__name__)
+
+DATA_DISCOVERY = 'xiaomi_ac_radio_discovery'
+STORAGE_VERSION = 1
+STORAGE_KEY = 'xiaomi_ac_radio.discovery'
+BROADCAST_ADDRESS = '255.255.255.255'
+DISCOVERY_TIMEOUT = 3
+HELLO_REPEATS = 3
+VERIFY_TIMEOUT = 2
+SCAN_TTL = 10
+
+
+def get_discovery(hass):
+    if DATA_DISCOVERY not in hass.data:
+        hass.data[DATA_DISCOVERY] = Discovery(hass)
+    return hass.data[DATA_DISCOVERY]
+
+
+class _HelloProtocol(asyncio.DatagramProtocol):
+    def __init__(self, responders):
+        self._responders = responders
+
+    def datagram_received(self, data, addr):
+        if len(data) == 32:
+            # the device id follows magic, length and an unknown field
+            self._responders[data[8:12].hex()] = addr[0]
+
+
+class Discovery:
+    def __init__(self, hass, address=BROADCAST_ADDRESS, timeout=DISCOVERY_TIMEOUT):
+        self._hass = hass
+        self._address = address
+        self._timeout = timeout
+        self._store = Store(hass, STORAGE_VERSION, STORAGE_KEY)
+        self._lock = asyncio.Lock()
+        self._device_ids = None
+        self._responders = {}
+        self._scanned = None
+
+    async def async_scan(self):
+        """Return {device_id: host} of every responder, shared for SCAN_TTL."""
+        async with self._lock:
+            if self._scanned is not None and time.monotonic() - self._scanned < SCAN_TTL:
+                return self._responders
+            responders = {}
+            transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+                lambda: _HelloProtocol(responders),
+                local_addr=('0.0.0.0', 0), allow_broadcast=True)
+            try:
+                for _ in range(HELLO_REPEATS):
+                    transport.sendto(HELLO, (self._address, MIIO_PORT))
+                    await asyncio.sleep(self._timeout / HELLO_REPEATS)
+            finally:
+                transport.close()
+            _LOGGER.debug("Discovered %s miio devices: %s", len(responders), responders)
+            self._responders = responders
+            self._scanned = time.monotonic()
+            return responders
+
+    async def _async_verify(self, host, token):
+        device = AsyncMiioDevice(host, token, VERIFY_TIMEOUT, 0)
+        try:
+            await device.async_send("miIO.info")
+            return device.device_id
+        except DeviceException:
+            return None
+        finally:
+            device.close()
+
+    async def async_find(self, token, host=None):
+        """Return the current address of the gateway with token, or None."""
+        if self._device_ids is None:
+            self._device_ids = (await self._store.async_load()) or {}
+        responders = await self.async_scan()
+        device_id = self._device_ids.get(token)
+        if device_id in responders:
+            return responders[device_id]
+        claimed = set(self._device_ids.values())
+        candidates = [address for did, address in responders.items() if did not in claimed]
+        # the configured address is the likely match, try it alone first
+        if host in candidates:
+            device_id = await self._async_verify(host, token)
+            if device_id is not None:
+                self.remember(token, device_id)
+                return host
+            candidates.remove(host)
+        results = await asyncio.gather(*(self._async_verify(address, token) for address in candidates))
+        for address, device_id in zip(candidates, results):
+            if device_id is not None:
+                self.remember(token, device_id)
+                return address
+        return None
+
+    def remember(self, token, device_id):
+        if self._device_ids is None or device_id is None:
+            return
+        if self._device_ids.get(token) != device_id:
+            self._device_ids[token] = device_id
+            self._store.async_delay_save(lambda: self._device_ids, 1)
@@ -0,0 +1,126 @@
+"""
+Channel and ringtone inventory of a Xiaomi Gateway Radio.
+
+The last known inventory is persisted so that after a restart the entity
+can show it right away while a fresh copy is fetched in the background.
+Refreshes fetch the channel pages and ringtone lists concurrently and are
+diffed against what is already known; unchanged lists keep their identity
+and nothing is saved, so the entity can skip rewriting identical state.
+"""
+import asyncio
+import logging
+import time
+
+from homeassistant.helpers.storage import Store
+
+_LOGGER = logging.getLogger(__name__)
+
+STORAGE_VERSION = 1
+STORAGE_KEY = 'xiaomi_ac_radio.inventory_{}'
+RINGTONE_TYPES = (('alarm', 0, True), ('clock', 1, True),
+                  ('chord', 2, True), ('custom', 3, False))
+PAGE_SIZE = 10
+PAGE_WINDOW = 3
+
+
+class Inventory:
+    def __init__(self, hass, device, unique_id, channel_ttl=3600):
+        self._hass = hass
+        self._device = device
+        self._channel_ttl = channel_ttl
+        self._positions = {}
+        self._loaded_at = None
+        self._store = Store(hass, STORAGE_VERSION,
+                            STORAGE_KEY.format(str(unique_id).replace(":", "")))
+        self.channels = []
+        self.space_free = None
+        self.ringtones = {name: [] for name, _, _ in RINGTONE_TYPES}
+
+    def _data(self):
+        return {
+            'channels': self.channels,
+            'space_free': self.space_free,
+            'ringtones': self.ringtones,
+        }
+
+    async def async_load(self):
+        data = await self._store.async_load()
+        if data:
+            self._set_channels(data.get('channels', []), False)
+            self.space_free = data.get('space_free')
+            self.ringtones.update(data.get('ringtones', {}))
+
+    def _set_channels(self, channels, fresh=True):
+        self.channels = channels
+        self._positions = {ch: idx for idx, ch in enumerate(channels)}
+        self._loaded_at = time.monotonic() if fresh else None
+
+    @property
+    def channels_stale(self):
+        return (self._loaded_at is None
+                or time.monotonic() - self._loaded_at > self._channel_ttl)
+
+    def neighbor(self, channel, step):
+        if not self.channels:
+            return None
+        index = self._positions.get(channel)
+        if index is None:
+            return self.channels[0]
+        return self.channels[(index + step) % len(self.channels)]
+
+    def _update_channels(self, channels):
+        if channels == self.channels:
+            self._loaded_at = time.monotonic()
+            return False
+        _LOGGER.debug("channels changed: +%s -%s",
+                      sorted(set(channels) - set(self.channels)),
+                      sorted(set(self.channels) - set(channels)))
+        self._set_channels(channels)
+        return True
+
+    async def async_refresh_channels(self):
+        if self._update_channels(await self.async_fetch_channels()):
+            self._store.async_delay_save(self._data, 1)
+
+    async def async_fetch_channels(self):
+        start = 0
+        channels = []
+        while True:
+            pages = await asyncio.gather(*(
+                self._device.async_send("get_channels", {"start": start + PAGE_SIZE * page})
+                for page in range(PAGE_WINDOW)))
+            for result in pages:
+                if "chs" not in result:
+                    return channels
+                for ch in result["chs"]:
+                    if "id" in ch:
+                        channels.append(ch["id"])
+            start += PAGE_SIZE * PAGE_WINDOW
+
+    async def async_fetch_ringtones(self, type, sysOnly = True):
+        ringtones = []
+        result = await self._device.async_send("get_music_info", [type])
+        if "list" in result:
+            for ringtone in result["list"]:
+                if (not sysOnly) or (int(ringtone["mid"]) < 1000):
+                    ringtones.append(ringtone["mid"])
+        return ringtones
+
+    async def async_refresh(self):
+        """Fetch everything at once, return whether anything changed."""
+        channels, space_free, *ringtones = await asyncio.gather(
+            self.async_fetch_channels(),
+            self._device.async_send("get_music_free_space", []),
+            *(self.async_fetch_ringtones(type, sysOnly) for _, type, sysOnly in RINGTONE_TYPES))
+        changed = self._update_channels(channels)
+        if space_free != self.space_free:
+            self.space_free = space_free
+            changed = True
+        for (name, _, _), mids in zip(RINGTONE_TYPES, ringtones):
+            if mids != self.ringtones.get(name):
+                # a new dict, published attributes must not change under the entity
+                self.ringtones = {**self.ringtones, name: mids}
+                changed = True
+        if changed:
+            self._store.async_delay_save(self._data, 1)
+        return changed
@@ -0,0 +1,156 @@
+"""
+Custom ringtone library for the Xiaomi Gateway Radio.
+
+Clips from a local directory get stable user-music mids, shared by every
+gateway, so that one automation can play the same ringtone everywhere.
+Each gateway remembers the content hash it holds per mid; a sync only
+uploads clips that are missing or changed and that fit into the free
+space, a few at a time per gateway.
+"""
+import asyncio
+import logging
+import os
+
+from miio import DeviceException
+
+from homeassistant.helpers.storage import Store
+
+from custom_components.xiaomi_ac_radio.cache import (
+    AUDIO_EXT, DATA_AUDIO_CACHES, file_hash)
+from custom_components.xiaomi_ac_radio.slots import free_space
+
+_LOGGER = logging.getLogger(__name__)
+
+DATA_LIBRARY = 'xiaomi_ac_radio_library'
+STORAGE_VERSION = 1
+STORAGE_KEY = 'xiaomi_ac_radio.library'
+DEVICE_STORAGE_KEY = 'xiaomi_ac_radio.library_{}'
+# below the announcement slots which start at 99900
+LIBRARY_BASE = 99800
+LIBRARY_SIZE = 100
+DOWNLOAD_TIMEOUT = 60
+
+
+def get_library(hass):
+    if DATA_LIBRARY not in hass.data:
+        library = hass.data[DATA_LIBRARY] = RingtoneLibrary(hass)
+        # lets the clip view serve library files by content hash
+        hass.data.setdefault(DATA_AUDIO_CACHES, {})[DATA_LIBRARY] = library
+    return hass.data[DATA_LIBRARY]
+
+
+def library_mid(mid):
+    try:
+        return LIBRARY_BASE <= int(mid) < LIBRARY_BASE + LIBRARY_SIZE
+    except (TypeError, ValueError):
+        return False
+
+
+class RingtoneLibrary:
+    def __init__(self, hass):
+        self._hass = hass
+        self._store = Store(hass, STORAGE_VERSION, STORAGE_KEY)
+        self._lock = asyncio.Lock()
+        self._mids = None
+        self._hashes = {}
+        self._files = {}
+
+    def file_path(self, key):
+        return self._files.get(key, '')
+
+    def _scan(self, path):
+        clips = []
+        for name in sorted(os.listdir(path)):
+            full = os.path.join(path, name)
+            if not name.lower().endswith(AUDIO_EXT) or not os.path.isfile(full):
+                continue
+            stat = os.stat(full)
+            # the same directory is scanned once per gateway
+            signature = (full, stat.st_mtime, stat.st_size)
+            if signature not in self._hashes:
+                self._hashes[signature] = file_hash(full)
+            clips.append({'name': os.path.splitext(name)[0], 'path': full,
+                          'hash': self._hashes[signature], 'size': stat.st_size})
+        return clips
+
+    async def async_scan(self, path):
+        """Return the clips of path, each with its stable mid."""
+        async with self._lock:
+            if self._mids is None:
+                self._mids = (await self._store.async_load()) or {}
+            clips = await self._hass.async_add_executor_job(self._scan, path)
+            used = set(self._mids.values())
+            free = (str(LIBRARY_BASE + i) for i in range(LIBRARY_SIZE)
+                    if str(LIBRARY_BASE + i) not in used)
+            result = []
+            for clip in clips:
+                if clip['name'] not in self._mids:
+                    mid = next(free, None)
+                    if mid is None:
+                        _LOGGER.warning("No library mid left for %s", clip['name'])
+                        continue
+                    self._mids[clip['name']] = mid
+                clip['mid'] = self._mids[clip['name']]
+                self._files[clip['hash']] = clip['path']
+                result.append(clip)
+            self._store.async_delay_save(lambda: self._mids, 1)
+            return result
+
+
+class DeviceLibrary:
+    def __init__(self, hass, device, unique_id, name):
+        self._hass = hass
+        self._device = device
+        self._name = name
+        self._store = Store(hass, STORAGE_VERSION,
+                            DEVICE_STORAGE_KEY.format(str(unique_id).replace(":", "")))
+
+    async def async_sync(self, clips, clip_url, downloads, limit=2, prune=False):
+        records = await self._store.async_load() or {}
+        result = await self._device.async_send("get_music_info", [3])
+        present = {str(music.get("mid"))
+                   for music in (result.get("list", []) if isinstance(result, dict) else [])}
+        records = {mid: clip for mid, clip in records.items() if mid in present}
+        summary = {'uploaded': [], 'unchanged': [], 'skipped': [], 'failed': [], 'removed': []}
+        if prune:
+            wanted = {clip['mid'] for clip in clips}
+            for mid in sorted(present):
+                if library_mid(mid) and mid not in wanted:
+                    await self._device.async_send("delete_user_music", [mid])
+                    records.pop(mid, None)
+                    summary['removed'].append(mid)
+        space = free_space(await self._device.async_send("get_music_free_space", []))
+        uploads = []
+        for clip in clips:
+            if records.get(clip['mid']) == clip['hash']:
+                summary['unchanged'].append(clip['name'])
+            elif clip['size'] > space:
+                summary['skipped'].append(clip['name'])
+            else:
+                space -= clip['size']
+                uploads.append(clip)
+        if summary['skipped']:
+            _LOGGER.warning("%s: not enough space for %s", self._name, summary['skipped'])
+        semaphore = asyncio.Semaphore(limit)
+
+        async def _upload(clip):
+            mid = clip['mid']
+            async with semaphore:
+                try:
+                    if mid in present:
+                        await self._device.async_send("delete_user_music", [mid])
+                    await self._device.async_send(
+                        "download_user_music", [mid, clip_url.format(clip['hash'])])
+                    done = await downloads.async_wait(mid, clip['size'], DOWNLOAD_TIMEOUT)
+                except DeviceException as ex:
+                    _LOGGER.error("%s: upload %s failed: %s", self._name, clip['name'], ex)
+                    done = False
+            if done:
+                records[mid] = clip['hash']
+                summary['uploaded'].append(clip['name'])
+            else:
+                records.pop(mid, None)
+                summary['failed'].append(clip['name'])
+        await asyncio.gather(*(_upload(clip) for clip in uploads))
+        self._store.async_delay_save(lambda: records, 1)
+        return summary
@@ -4,13 +4,11 @@ Support for the Xiaomi Gateway Radio.
 For more details about this platform, please refer to the documentation
 https://home-assistant.io/components/radio.xiaomi_miio/
 """
-import functools
 import logging
 import time
 import json
 import os
-import urllib
-import requests
+import uuid
 import asyncio
 import async_timeout
 import sys
@@ -21,18 +19,45 @@ sys.path.append("../..")
 # 这里面有很多有价值的代码
 
 from datetime import timedelta
-from haffmpeg.core import HAFFmpeg
 
 import voluptuous as vol
+from aiohttp import hdrs
 
 from custom_components.miio_acpartner import (
-    PLATFORM_SCHEMA, DOMAIN, ATTR_VOLUME, RadioDevice)
+    PLATFORM_SCHEMA, DOMAIN, DATA_POLLER, ATTR_VOLUME, ATTR_POLICY,
+    ATTR_MESSAGES, ATTR_URLS, ATTR_PRELOAD, ATTR_PATH, ATTR_CONCURRENCY,
+    ATTR_PRUNE, EVENT_RINGTONES_SYNCED, POLICY_QUEUE, RadioDevice)
+from custom_components.xiaomi_ac_radio.announce import AnnouncementQueue
+from custom_components.xiaomi_ac_radio.cache import (
+    async_shared, cache_key, file_hash, get_audio_cache, remove_file)
+from custom_components.xiaomi_ac_radio.commands import (
+    CommandScheduler, KIND_CHANNEL, KIND_POWER, KIND_VOLUME)
+from custom_components.xiaomi_ac_radio.discovery import get_discovery
+from custom_components.xiaomi_ac_radio.inventory import Inventory
+from custom_components.xiaomi_ac_radio.library import DeviceLibrary, get_library
+from custom_components.xiaomi_ac_radio.progress import DownloadTracker
+from custom_components.xiaomi_ac_radio.protocol import AsyncMiioDevice
+from custom_components.xiaomi_ac_radio.server import CLIP_URL, get_clip_store
+from custom_components.xiaomi_ac_radio.slots import MAX_SLOTS, GatewaySlots
+from custom_components.xiaomi_ac_radio.stats import (
+    LatencyStats, Trace, span, STAGE_SYNTHESIS, STAGE_FETCH, STAGE_TRANSCODE,
+    STAGE_DOWNLOAD, STAGE_PLAYBACK)
+from custom_components.xiaomi_ac_radio.tts import (
+    BaiduTTS, CommandTTS, FakeTTS, ENGINE_BAIDU, ENGINE_COMMAND, ENGINE_FAKE,
+    TTS_ENGINES, DEFAULT_TTS_COMMAND, split_message)
+from custom_components.xiaomi_ac_radio.vod import (
+    async_read, async_tee, get_source_cache)
+from custom_components.xiaomi_ac_radio.transcode import (
+    CHUNK_SIZE, PROFILE_MUSIC, PROFILE_SPEECH, async_stream_convert,
+    clip_duration, get_transcode_pool)
 from homeassistant.components.ffmpeg import (
     DATA_FFMPEG, CONF_EXTRA_ARGUMENTS)    
 from homeassistant.const import (
     CONF_NAME, CONF_TOKEN, CONF_TIMEOUT,
-    ATTR_ENTITY_ID, ATTR_HIDDEN, CONF_COMMAND)
+    ATTR_ENTITY_ID, ATTR_HIDDEN, CONF_COMMAND, STATE_UNAVAILABLE)
 from homeassistant.exceptions import PlatformNotReady
+from homeassistant.helpers.aiohttp_client import async_get_clientsession
+from homeassistant.helpers.storage import Store
 import homeassistant.helpers.config_validation as cv
 from homeassistant.util.dt import utcnow
 
@@ -47,6 +72,24 @@ CONF_BASEURL = "base_url"
 CONF_BASEPATH = "base_path"
 CONF_NOTIFY = "notify"
 CONF_HOST = "host"
+CONF_DISCOVERY = "discovery"
+CONF_CACHE_ENTRIES = "cache_entries"
+CONF_CACHE_SIZE = "cache_size"
+CONF_SLOT_COUNT = "slot_count"
+CONF_CHANNEL_TTL = "channel_ttl"
+CONF_TRANSCODE_WORKERS = "transcode_workers"
+CONF_CLIP_MEMORY = "clip_memory"
+CONF_TTS_ENGINES = "tts_engines"
+CONF_TTS_COMMAND = "tts_command"
+CONF_TRACE = "trace"
+CONF_RETRIES = "retries"
+CONF_COMMAND_BUDGET = "command_budget"
+CONF_PROBE_INTERVAL = "probe_interval"
+CONF_VOD_CACHE_SIZE = "vod_cache_size"
+SEGMENT_FANOUT = 3
+
+DATA_KNOWN_DEVICES = 'xiaomi_ac_radio_devices'
+STORAGE_KEY_DEVICES = 'xiaomi_ac_radio.devices'
 
 LEARN_COMMAND_SCHEMA = vol.Schema({
     vol.Required(ATTR_ENTITY_ID): vol.All(str),
@@ -58,7 +101,7 @@ COMMAND_SCHEMA = vol.Schema({
 
 PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend({
     vol.Optional(CONF_NAME): cv.string,
-    vol.Required(CONF_HOST): cv.string,
+    vol.Optional(CONF_HOST): cv.string,
     vol.Required(CONF_TOKEN): vol.All(str, vol.Length(min=32, max=32)),
     vol.Optional(CONF_APIKEY): cv.string,
     vol.Optional(CONF_SECRETKEY): cv.string,
@@ -69,12 +112,57 @@ PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend({
     vol.Optional(CONF_VOLUME, default = '4'): cv.string,
     vol.Optional(CONF_PERSON, default = '0'): cv.string,
     vol.Optional(CONF_NOTIFY, default = False): cv.boolean,
+    vol.Optional(CONF_CACHE_ENTRIES, default = 100): cv.positive_int,
+    vol.Optional(CONF_CACHE_SIZE, default = 50): cv.positive_int,
+    vol.Optional(CONF_TIMEOUT, default = 5): cv.positive_int,
+    vol.Optional(CONF_CHANNEL_TTL, default = 3600): cv.positive_int,
+    vol.Optional(CONF_TRANSCODE_WORKERS, default = 2): cv.positive_int,
+    vol.Optional(CONF_CLIP_MEMORY, default = 16): cv.positive_int,
+    vol.Optional(CONF_TTS_ENGINES, default = [ENGINE_BAIDU]): vol.All(cv.ensure_list, [vol.In(TTS_ENGINES)]),
+    vol.Optional(CONF_TTS_COMMAND, default = DEFAULT_TTS_COMMAND): cv.string,
+    vol.Optional(CONF_TRACE, default = False): cv.boolean,
+    vol.Optional(CONF_SLOT_COUNT, default = 10): vol.All(vol.Coerce(int), vol.Range(min=1, max=MAX_SLOTS)),
+    vol.Optional(CONF_RETRIES, default = 3): vol.All(vol.Coerce(int), vol.Range(min=0, max=10)),
+    vol.Optional(CONF_COMMAND_BUDGET, default = 10): cv.positive_int,
+    vol.Optional(CONF_PROBE_INTERVAL, default = 30): cv.positive_int,
+    vol.Optional(CONF_VOD_CACHE_SIZE, default = 100): cv.positive_int,
+    vol.Optional(CONF_DISCOVERY, default = False): cv.boolean,
 }, extra=vol.ALLOW_EXTRA)
 
 
-@asyncio.coroutine
-def async_setup_platform(hass, config, async_add_devices, discovery_info=None):
-    from miio import Device, DeviceException
+async def async_known_devices(hass):
+    if DATA_KNOWN_DEVICES not in hass.data:
+        store = Store(hass, 1, STORAGE_KEY_DEVICES)
+
+        async def _async_load():
+            return store, (await store.async_load()) or {}
+        hass.data[DATA_KNOWN_DEVICES] = hass.async_create_task(_async_load())
+    return await asyncio.shield(hass.data[DATA_KNOWN_DEVICES])
+
+
+async def async_detect_device(hass, device, token):
+    from miio import DeviceException
+    store, known = await async_known_devices(hass)
+    try:
+        device_info = await device.async_info()
+    except DeviceException as ex:
+        if token in known:
+            _LOGGER.warning("%s is not responding, use the last known identity: %s", device.host, ex)
+            return known[token]
+        raise
+    unique_id = "{}-{}".format(device_info.model, device_info.mac_address)
+    _LOGGER.info("%s %s %s detected",
+                 device_info.model,
+                 device_info.firmware_version,
+                 device_info.hardware_version)
+    if known.get(token) != unique_id:
+        known[token] = unique_id
+        store.async_delay_save(lambda: known, 1)
+    return unique_id
+
+
+async def async_setup_platform(hass, config, async_add_devices, discovery_info=None):
+    from miio import DeviceException
 
     host = config.get(CONF_HOST)
     token = config.get(CONF_TOKEN)
@@ -87,151 +175,93 @@ def async_setup_platform(hass, config, async_add_devices, discovery_info=None):
     volume = config.get(CONF_VOLUME, 5) 
     person = config.get(CONF_PERSON, 0) 
     notify = config.get(CONF_NOTIFY, False)
-    _LOGGER.info("Initializing with host %s (token %s...)", host, token[:5])
-    device = Device(host, token, lazy_discover=False)
-    try:
-        device_info = device.info()
-        model = device_info.model
-        unique_id = "{}-{}".format(model, device_info.mac_address)
-        _LOGGER.info("%s %s %s detected",
-                     model,
-                     device_info.firmware_version,
-                     device_info.hardware_version)
-    except DeviceException as ex:
-        _LOGGER.error("Device unavailable or token incorrect: %s", ex)
-        raise PlatformNotReady
-    friendly_name = config.get(CONF_NAME, "miio_miio_acpartner_" + host.replace('.', '_'))
-    xiaomi_miio_radio = XiaomiMiioRadio(hass, friendly_name, device, unique_id, apiKey, secretKey, speed, pitch, volume, person, baseUrl, basePath, notify)
-    async_add_devices([xiaomi_miio_radio])
-
-TOKEN_INTERFACE = 'https://openapi.baidu.com/oauth/2.0/token'
-TEXT2AUDIO_INTERFACE = 'http://tsn.baidu.com/text2audio'
-def get_url(url, verify, params) -> object:
-    return requests.get(url, verify=verify, params=params)  
-class BaiduTTS:
-    def __init__(self, hass, apiKey, secretKey, speed = 5, pitch = 5, volume = 15, person = 0):
-        self._hass = hass
-        self.apiKey = apiKey
-        self.secretKey = secretKey
-        self.speed = speed
-        self.pitch = pitch
-        self.volume = volume
-        self.person = person
-        self.Token = None
-    @asyncio.coroutine
-    def get_token(self):
+    engines = []
+    for engine in config.get(CONF_TTS_ENGINES):
+        if engine == ENGINE_BAIDU:
+            if apiKey == None or secretKey == None:
+                _LOGGER.warning("The baidu tts api key is not configured.")
+                continue
+            engines.append(BaiduTTS(hass, apiKey, secretKey, speed, pitch, volume, person))
+        elif engine == ENGINE_COMMAND:
+            engines.append(CommandTTS(config.get(CONF_TTS_COMMAND)))
+        elif engine == ENGINE_FAKE:
+            engines.append(FakeTTS())
+    if not baseUrl:
+        baseUrl = hass.config.api.base_url
+    cachePath = basePath + "/www/tts_cache" if basePath else hass.config.path("tts_cache")
+    cache = get_audio_cache(hass, cachePath,
+                            config.get(CONF_CACHE_ENTRIES),
+                            config.get(CONF_CACHE_SIZE) * 1024 * 1024)
+    sources = get_source_cache(hass, os.path.join(cachePath, "vod"),
+                               config.get(CONF_VOD_CACHE_SIZE) * 1024 * 1024)
+    get_transcode_pool(hass, config.get(CONF_TRANSCODE_WORKERS))
+    get_clip_store(hass, config.get(CONF_CLIP_MEMORY) * 1024 * 1024)
+    resolver = None
+    if config.get(CONF_DISCOVERY) or not host:
+        # one broadcast is shared by all gateways set up at the same time
+        discovery = get_discovery(hass)
+        resolver = ft.partial(discovery.async_find, token)
         try:
-            resp = yield from self._hass.async_add_executor_job(get_url, TOKEN_INTERFACE, False, {'grant_type': 'client_credentials',
-                                                         'client_id': self.apiKey,
-                                                         'client_secret':self.secretKey})
-            if resp.status_code != 200:
-                _LOGGER.error('Get ToKen Http Error status_code:%s' % resp.status_code)
-                return None
-            resp.encoding = 'utf-8'
-            tokenJson = resp.json()
-            if not 'access_token' in tokenJson:
-                _LOGGER.error('Get ToKen Json Error!')
-                return None
-            return tokenJson['access_token']
-        except Exception as ex:
-            _LOGGER.error(ex)
-            return None
-    @asyncio.coroutine
-    def generate_tts(self, message, file):
+            found = await discovery.async_find(token, host)
+        except OSError as ex:
+            _LOGGER.warning("Discovery failed: %s", ex)
+            found = None
+        if found is None and not host:
+            _LOGGER.error("No gateway with token %s... answered the discovery.", token[:5])
+            raise PlatformNotReady
+        if found is not None and found != host:
+            if host:
+                _LOGGER.warning("%s answers at %s now", host, found)
+            host = found
+    _LOGGER.info("Initializing with host %s (token %s...)", host, token[:5])
+    device = AsyncMiioDevice(host, token, config.get(CONF_TIMEOUT),
+                             config.get(CONF_RETRIES),
+                             config.get(CONF_COMMAND_BUDGET),
+                             config.get(CONF_PROBE_INTERVAL),
+                             resolver)
+    _, known = await async_known_devices(hass)
+    if token in known:
+        unique_id = known[token]
+        hass.async_create_task(async_detect_device(hass, device, token))
+    else:
         try:
-            if self.Token == None:
-                self.Token = yield from self.get_token()
-            if self.Token == None:
-                _LOGGER.error('get_tts_audio Self.ToKen is nil')
-                return False
-            resp = yield from self._hass.async_add_executor_job(get_url, TEXT2AUDIO_INTERFACE, False, {'tex': urllib.parse.quote(message),
-                                                             'lan': 'zh',
-                                                             'tok': self.Token,
-                                                             'ctp': '1',
-                                                             'aue': 6,
-                                                             'cuid': 'HomeAssistant',
-                                                             'spd': self.speed,
-                                                             'pit': self.pitch,
-                                                             'vol': self.volume,
-                                                             'per': self.person})
-            if resp.status_code == 500:
-                _LOGGER.error('Text2Audio Error:500 Not Support.')
-                return False
-            if resp.status_code == 501:
-                _LOGGER.error('Text2Audio Error:501 Params Error')
-                return False
-            if resp.status_code == 502:
-                _LOGGER.wran('Text2Audio Error:502 TokenVerificationError, Now Get Token!')
-                self.Token = yield from self.get_token()
-                res = yield from self.generate_tts(message, file)
-                return res
-            if resp.status_code == 503:
-                _LOGGER.error('Text2Audio Error:503 Composite Error.')
-                return False
-            if resp.status_code != 200:
-                _LOGGER.error('get_tts_audio Http Error status_code:%s' % resp.status_code)
-                return False
-            open(file, "wb").write(resp.content)
-            return True    
-        except Exception as ex:
-            _LOGGER.error(ex)
-            return False
+            unique_id = await async_detect_device(hass, device, token)
+        except DeviceException as ex:
+            _LOGGER.error("Device unavailable or token incorrect: %s", ex)
+            device.close()
+            raise PlatformNotReady
+    # a discovered address may change, name those after the token instead
+    friendly_name = config.get(CONF_NAME, "miio_miio_acpartner_" + (config.get(CONF_HOST) or token[:8]).replace('.', '_'))
+    xiaomi_miio_radio = XiaomiMiioRadio(hass, friendly_name, device, unique_id, engines, baseUrl, notify, cache, sources, config.get(CONF_SLOT_COUNT), config.get(CONF_CHANNEL_TTL), config.get(CONF_TRACE))
+    async_add_devices([xiaomi_miio_radio])
 
-class AacConverter(HAFFmpeg):
-    @asyncio.coroutine
-    def convert(self, input_source, output, extra_cmd=None, timeout=15):
-        command = [
-            "-vn",
-            "-c:a",
-            "aac",
-            "-strict",
-            "-2",
-            "-b:a",
-            "64K",
-            "-ar",
-            "48000",
-            "-ac",
-            "2",
-            "-y"
-        ]      
-        is_open = yield from self.open(cmd=command, input_source=input_source, output=output, extra_cmd=extra_cmd)         
-        if not is_open:
-            _LOGGER.warning("Error starting FFmpeg.")
-            return False
-        try:
-            proc_func = functools.partial(self._proc.communicate, timeout=timeout)
-            out, error = yield from self._loop.run_in_executor(None, proc_func)
-        except (asyncio.TimeoutError, ValueError):
-            _LOGGER.error("Timeout convert audio file.")
-            self._proc.kill()
-            return False    
-        return True         
-            
 class XiaomiMiioRadio(RadioDevice):
-    def __init__(self, hass, friendly_name, device, unique_id, apiKey, secretKey, speed, pitch, volume, person, baseUrl, basePath, notify):
+    def __init__(self, hass, friendly_name, device, unique_id, engines, baseUrl, notify, cache, sources, slotCount, channelTtl, trace):
         self._hass = hass
         self._name = friendly_name
         self._device = device
         self._unique_id = unique_id
         self._state = False
-        self._baidu = None
-        self._apiKey = apiKey
-        self._secretKey = secretKey
-        self._speed = speed
-        self._pitch = pitch
-        self._volume = volume
-        self._person = person
-        self._mp3Path = basePath + "/www/tts_" + str(unique_id).replace(":", "") + ".wav"
-        self._aacPath = basePath + "/www/tts_" + str(unique_id).replace(":", "") + ".aac"
-        self._ttsUrl = baseUrl + "/local/tts_" + str(unique_id).replace(":", "") + ".aac"
+        self._engines = engines
+        self._aacPath = os.path.join(cache.path, "tts_" + str(unique_id).replace(":", "") + ".aac")
+        self._clipUrl = baseUrl + CLIP_URL
+        self._cache = cache
+        self._sources = sources
+        self._slots = GatewaySlots(hass, device, unique_id, slotCount)
+        self._downloads = DownloadTracker(device, friendly_name)
+        self._commands = CommandScheduler(hass, device, friendly_name, on_idle=self._schedule_update)
         self._notify = notify
-        self._channels = self.all_channels()
-        self._spaceFree = self._device.send("get_music_free_space", [])
-        self._alarm = self.all_ringtones(0)
-        self._clock = self.all_ringtones(1)
-        self._chord = self.all_ringtones(2)
-        self._custom = self.all_ringtones(3, False)
+        self._announcements = AnnouncementQueue(hass, friendly_name)
+        self._latency = LatencyStats(friendly_name, debug=trace)
+        self._inventory = Inventory(hass, device, unique_id, channelTtl)
+        self._library = DeviceLibrary(hass, device, unique_id, friendly_name)
+        self._library_status = None
+        self._channel = None
+        self._prerender = {'total': 0, 'done': 0, 'failed': []}
+        self._transcode = None
+        self._bytes_saved = 0
         self._state = False
+        self._written = None
         self._attributes = {}
     @property
     def name(self):
@@ -244,199 +274,426 @@ class XiaomiMiioRadio(RadioDevice):
         return self._state
     @property
     def should_poll(self):
-        return True
-    def all_channels(self):
-        index = 0
-        channels = []
-        result = self._device.send("get_channels", {"start": 0})
-        while "chs" in result:
-            for ch in result["chs"]:
-                if "id" in ch:
-                    channels.append(ch["id"])
-            index = index + 10
-            result = self._device.send("get_channels", {"start": index})
-        return channels
-    def all_ringtones(self, type, sysOnly = True):
-        ringtones = []
-        result = self._device.send("get_music_info", [type])
-        if "list" in result:
-            result = result["list"]
-            for ringtone in result:
-                if (not sysOnly) or (int(ringtone["mid"]) < 1000):
-                    ringtones.append(ringtone["mid"])
-        return ringtones
+        return False
+    @property
+    def available(self):
+        return self._device.available
     @property
     def device_state_attributes(self):
         return self._attributes
 
-    @asyncio.coroutine
-    def async_update(self):
-        return self.hass.async_add_job(ft.partial(self.update_state))
+    async def async_added_to_hass(self):
+        await self._inventory.async_load()
+        await self._slots.async_load()
+        self.hass.data[DATA_POLLER].async_add(self)
+        self.hass.async_create_task(self.async_verify_slots())
+        self.hass.async_create_task(self.async_refresh_inventory())
+
+    async def async_verify_slots(self):
+        from miio import DeviceException
+        try:
+            await self._slots.async_verify()
+        except DeviceException as ex:
+            _LOGGER.warning("Query user music of %s failed: %s", self._name, ex)
+
+    async def async_refresh_inventory(self):
+        from miio import DeviceException
+        try:
+            changed = await self._inventory.async_refresh()
+        except DeviceException as ex:
+            _LOGGER.error("Load inventory of %s failed: %s", self._name, ex)
+            return
+        if changed or self._written is None:
+            self.hass.data[DATA_POLLER].async_request_refresh(self, 0)
+
+    async def async_sync(self, **kwargs):
+        await self.async_refresh_inventory()
+        await self.async_verify_slots()
+
+    async def async_will_remove_from_hass(self):
+        self.hass.data[DATA_POLLER].async_remove(self)
+        self._device.close()
+        await self.hass.async_add_executor_job(self._cache.flush)
 
-    def update_state(self):
+    async def async_update(self):
+        await self.hass.data[DATA_POLLER].async_refresh(self)
+
+    async def async_update_state(self):
         from miio import DeviceException
+        attributes = self._attributes
         try:
-            status = self._device.send("get_prop_fm", [])
-            self._attributes = {
+            status = await self._device.async_send("get_prop_fm", [])
+            attributes = {
                 'hidden': 'true',
-                'miio_channels': self._channels,
-                'space_free': self._spaceFree,
+                'miio_channels': self._inventory.channels,
+                'space_free': self._inventory.space_free,
                 'channel': status["current_program"],
                 'volume': status["current_volume"],
-                'miio_ringtones': {
-                    'alarm': self._alarm,
-                    'clock': self._clock,
-                    'chord': self._chord,
-                    'custom': self._custom
-                }
+                'miio_ringtones': self._inventory.ringtones,
             }
-            self._state = status["current_status"] == "run"
+            if not self._commands.length:
+                # don't undo optimistic values while a burst is still being sent
+                self._channel = status["current_program"]
+                self._state = status["current_status"] == "run"
         except DeviceException:
-            self._state = False        
-        self.hass.states.async_set(DOMAIN + "." + self._name, "on" if self._state else "off", self._attributes)
-        
-    @asyncio.coroutine
-    def async_toggle(self, **kwargs):
-        if self.is_on:
-            self._device.send('play_fm', ["off"])
+            self._state = False
+        if not self.available:
+            state = STATE_UNAVAILABLE
         else:
-            self._device.send('play_fm', ["on"])
-        self.hass.async_add_job(ft.partial(self.update_state))
+            state = "on" if self._state else "off"
+        if state != self._written or attributes != self._attributes:
+            self._written = state
+            self._attributes = attributes
+            self.hass.states.async_set(DOMAIN + "." + self._name, state, attributes)
+        # counters change on every poll, keep them away from the large
+        # channel and ringtone lists so the recorder doesn't copy those
+        self.hass.states.async_set(DOMAIN + "." + self._name + "_stats", state, {
+            'hidden': 'true',
+            'tts_cache_hits': self._cache.hits,
+            'tts_cache_misses': self._cache.misses,
+            'tts_cache_entries': self._cache.entries,
+            'vod_cache_hits': self._sources.hits,
+            'vod_cache_misses': self._sources.misses,
+            'vod_cache_entries': self._sources.entries,
+            'user_music_slots': self._slots.resident,
+            'download_throughput': None if self._downloads.throughput is None else int(self._downloads.throughput),
+            'in_flight': self._device.in_flight,
+            'commands_sent': self._commands.sent,
+            'commands_coalesced': self._commands.coalesced,
+            'prerender_total': self._prerender['total'],
+            'prerender_done': self._prerender['done'],
+            'prerender_failed': list(self._prerender['failed']),
+            'announce_queue': self._announcements.length,
+            'announce_wait': round(self._announcements.last_wait, 3),
+            'latency': self._latency.percentiles,
+            'last_transcode': self._transcode,
+            'ringtone_library': self._library_status,
+            'transcode_bytes_saved': self._bytes_saved,
+        })
+        # shared by every gateway, identical writes are dropped by the state machine
+        pool = get_transcode_pool(self.hass)
+        self.hass.states.async_set(DOMAIN + ".transcode_pool", pool.queue_depth,
+                                   dict(pool.metrics, hidden='true'))
+
+    def _schedule_update(self):
+        self.hass.data[DATA_POLLER].async_request_refresh(self)
+
+    async def _async_send(self, command, parameters):
+        from miio import DeviceException
+        try:
+            await self._device.async_send(command, parameters)
+        except DeviceException as error:
+            _LOGGER.error(error)
+            return False
+        return True
+        
+    async def _async_power(self, on):
+        # optimistic, so that a burst of toggles flips from the latest value
+        self._state = on
+        return await self._commands.async_submit(KIND_POWER, 'play_fm', ["on" if on else "off"])
+    async def async_toggle(self, **kwargs):
+        return await self._async_power(not self.is_on)
     # pylint: disable=R0201
-    @asyncio.coroutine
-    def async_turn_on(self, **kwargs):
-        self._device.send('play_fm', ["on"])
-        self.hass.async_add_job(ft.partial(self.update_state))
-    @asyncio.coroutine
-    def async_turn_off(self, **kwargs):
-        self._device.send('play_fm', ["off"])
-        self.hass.async_add_job(ft.partial(self.update_state))
+    async def async_turn_on(self, **kwargs):
+        return await self._async_power(True)
+    async def async_turn_off(self, **kwargs):
+        return await self._async_power(False)
                     
-    def set_volume(self, volume, **kwargs):
+    async def async_set_volume(self, volume, **kwargs):
         if volume is None:
             _LOGGER.debug("Empty packet.")
             return True
+        return await self._commands.async_submit(KIND_VOLUME, 'volume_ctrl_fm', [str(volume)])
+    async def _async_play_channel(self, channel):
+        # later steps start from here even before the gateway switched
+        self._channel = channel
+        return await self._commands.async_submit(KIND_CHANNEL, 'play_specify_fm', {'id': channel, 'type': 0})
+    async def _async_step_radio(self, step):
+        from miio import DeviceException
         try:
-            self._device.send('volume_ctrl_fm', [str(volume)])
-        except ValueError as error:
+            if self._inventory.channels_stale:
+                await self._inventory.async_refresh_channels()
+            if self._channel is None:
+                status = await self._device.async_send("get_prop_fm", [])
+                self._channel = status["current_program"]
+        except DeviceException as error:
             _LOGGER.error(error)
             return False
-        self.hass.async_add_job(ft.partial(self.update_state))
-        return True  
-    def next_radio(self, **kwargs):
-        try:
-            status = self._device.send("get_prop_fm", [])
-            channel = status["current_program"]
-            channels = self.all_channels()
-            if len(channels) < 1:
-                return False
-            current_index = -1
-            for idx, val in enumerate(channels):
-                if val == channel:
-                    current_index = idx
-                    break
-            if current_index == -1:
-                current_index = 0
-            elif current_index >= len(channels) - 1:
-                current_index = 0
-            else:
-                current_index = current_index + 1
-            channel = channels[current_index]
-            self._device.send("play_specify_fm", {'id': channel, 'type': 0})
-        except ValueError as error:
-            _LOGGER.error(error)
-            return False
-        self.hass.async_add_job(ft.partial(self.update_state))
-        return True
-    def prev_radio(self, **kwargs):
-        try:
-            status = self._device.send("get_prop_fm", [])
-            channel = status["current_program"]
-            channels = self.all_channels()
-            if len(channels) < 1:
-                return False
-            current_index = -1
-            for idx, val in enumerate(channels):
-                if val == channel:
-                    current_index = idx
-                    break
-            if current_index == -1:
-                current_index = 0
-            elif current_index == 0:
-                current_index = len(channels) - 1
-            else:
-                current_index = current_index - 1
-            channel = channels[current_index]
-            self._device.send("play_specify_fm", {'id': channel, 'type': 0})
-        except ValueError as error:
-            _LOGGER.error(error)
+        channel = self._inventory.neighbor(self._channel, step)
+        if channel is None:
             return False
-        self.hass.async_add_job(ft.partial(self.update_state))
-        return True  
+        return await self._async_play_channel(channel)
+    async def async_next_radio(self, **kwargs):
+        return await self._async_step_radio(1)
+    async def async_prev_radio(self, **kwargs):
+        return await self._async_step_radio(-1)
 
-    def play_radio(self, program_id, **kwargs):
+    async def async_play_radio(self, program_id, **kwargs):
         if program_id is None:
             return True
         try:
-            self._device.send('play_specify_fm', {'id': int(str(program_id)), 'type': 0})
+            channel = int(str(program_id))
         except ValueError as error:
+            _LOGGER.error(error)
             return False
-        self.hass.async_add_job(ft.partial(self.update_state))
-        return True
-    @asyncio.coroutine
-    def async_play_ringtone(self, ringtone_id, **kwargs):
+        return await self._async_play_channel(channel)
+    async def async_play_ringtone(self, ringtone_id, **kwargs):
         if ringtone_id is None:
             return True
         volume = kwargs.get(ATTR_VOLUME)
         try:
             if volume == None:
-                self._device.send('play_music',[int(str(ringtone_id))])
+                return await self._async_send('play_music',[int(str(ringtone_id))])
             else:    
-                self._device.send('play_music_new', [str(ringtone_id), int(str(volume))])
+                return await self._async_send('play_music_new', [str(ringtone_id), int(str(volume))])
         except ValueError as error:
             return False
+
+    async def _async_synthesize(self, engine, message, trace=None):
+        key = cache_key(engine.cache_key(message), PROFILE_SPEECH)
+        cached = await self.hass.async_add_executor_job(self._cache.get, key)
+        if cached is not None:
+            return key
+        # gateways announcing or prerendering the same text share one encode
+        return await async_shared(self.hass, (self._cache.path, key),
+                                  ft.partial(self._async_encode_tts, engine, message, key, trace))
+
+    async def _async_encode_tts(self, engine, message, key, trace):
+        output = self._temp_path()
+        async def _job():
+            with span(trace, STAGE_SYNTHESIS):
+                stream = await engine.async_open(message, trace)
+            if stream is None:
+                _LOGGER.error("generate tts with %s failed.", engine.name)
+                return False
+            try:
+                with span(trace, STAGE_TRANSCODE):
+                    return await async_stream_convert(self.hass.data[DATA_FFMPEG].binary, stream.chunks, output, PROFILE_SPEECH)
+            finally:
+                await stream.async_close()
+        try:
+            result = await get_transcode_pool(self.hass).async_submit(_job)
+            if (not result) or (not os.path.exists(output)) or (os.path.getsize(output) < 1):
+                _LOGGER.error("Convert file to aac failed.")
+                return None
+            self._record_transcode(result)
+            await self.hass.async_add_executor_job(self._cache.put, key, output, result['duration'])
+            return key
+        finally:
+            await self.hass.async_add_executor_job(remove_file, output)
+
+    def _temp_path(self):
+        # broadcasts, prerenders and segments render side by side, never into one file
+        return "%s_%s.aac" % (os.path.splitext(self._aacPath)[0], uuid.uuid4().hex[:12])
+
+    def _record_transcode(self, result):
+        self._transcode = result
+        self._bytes_saved += result['saved']
+        _LOGGER.debug("%s encoded %s clip: %s bytes -> %s bytes (%ss), saved %s bytes in %ss",
+                      self._name, result['profile'], result['input'], result['size'],
+                      result['duration'], result['saved'], result['encode'])
+
+    async def async_render_tts(self, message, trace=None):
+        if not self._engines:
+            _LOGGER.error("No tts engine is configured.")
+            return None
+        for engine in self._engines:
+            key = await self._async_synthesize(engine, message, trace)
+            if key is not None:
+                break
+        if key is None:
+            return None
+        data = await self.hass.async_add_executor_job(get_clip_store(self.hass).load, key, self._cache.file_path(key))
+        if data is None:
+            _LOGGER.error("Load tts file failed.")
+            return None
+        # segments are scheduled by this, the size based guess is only for old entries
+        duration = self._cache.duration(key) or clip_duration(len(data), PROFILE_SPEECH)
+        return {'url': self._clipUrl.format(key), 'hash': key, 'size': len(data),
+                'duration': duration, 'timeout': 10}
+
+    async def async_render_vod(self, url, trace=None):
+        rendered = await async_shared(self.hass, (self._sources.path, url),
+                                      ft.partial(self._async_encode_vod, url, trace))
+        if rendered is None:
+            return None
+        clip, duration = rendered
+        data = await self.hass.async_add_executor_job(get_clip_store(self.hass).load, clip, self._sources.file_path(clip))
+        if data is None:
+            data = await self.hass.async_add_executor_job(get_clip_store(self.hass).load, clip, self._cache.file_path(clip))
+        if data is None:
+            _LOGGER.error("Load vod file failed.")
+            return None
+        return {'url': self._clipUrl.format(clip), 'hash': clip, 'size': len(data),
+                'duration': duration or clip_duration(len(data), PROFILE_MUSIC), 'timeout': 60}
+
+    async def _async_encode_vod(self, url, trace):
+        """Fetch and encode url unless the cache is current, return (clip, duration)."""
+        entry = await self.hass.async_add_executor_job(self._sources.lookup, url)
+        part = self._sources.part_path(url)
+        binary = self.hass.data[DATA_FFMPEG].binary
+        fetched = {}
+        output = self._temp_path()
+        async def _job():
+            if entry is not None and not entry['encoded']:
+                # the AAC is gone but the source is still here
+                with span(trace, STAGE_TRANSCODE):
+                    return await async_stream_convert(binary, async_read(self.hass, self._sources.source_path(url)), output, PROFILE_MUSIC)
+            headers = {}
+            if entry is not None and entry['etag']:
+                headers[hdrs.IF_NONE_MATCH] = entry['etag']
+            if entry is not None and entry['modified']:
+                headers[hdrs.IF_MODIFIED_SINCE] = entry['modified']
+            session = async_get_clientsession(self.hass)
+            with span(trace, STAGE_FETCH):
+                resp = await session.get(url, headers=headers)
+            async with resp:
+                fetched.update(etag=resp.headers.get(hdrs.ETAG), modified=resp.headers.get(hdrs.LAST_MODIFIED))
+                if resp.status == 304 and entry is not None:
+                    return {'cached': True}
+                resp.raise_for_status()
+                done = []
+                with span(trace, STAGE_TRANSCODE):
+                    result = await async_stream_convert(binary, async_tee(self.hass, resp.content.iter_chunked(CHUNK_SIZE), part, done), output, PROFILE_MUSIC)
+                fetched['complete'] = bool(done)
+                return result
+        try:
+            result = await get_transcode_pool(self.hass).async_submit(_job)
+            if result and result.get('cached'):
+                _LOGGER.debug("%s is not modified, use the cached clip", url)
+                await self.hass.async_add_executor_job(self._sources.hit, url, fetched['etag'], fetched['modified'])
+                clip = entry['clip']
+                duration = entry.get('duration')
+            else:
+                if (not result) or (not os.path.exists(output)) or (os.path.getsize(output) < 1):
+                    _LOGGER.error("Convert file to aac failed.")
+                    return None
+                self._record_transcode(result)
+                duration = result['duration']
+                clip = None
+                if not fetched:
+                    clip = await self.hass.async_add_executor_job(self._sources.encoded, url, output, duration)
+                elif fetched['complete']:
+                    clip = await self.hass.async_add_executor_job(self._sources.put, url, fetched['etag'], fetched['modified'], part, output, duration)
+                if clip is None:
+                    # ffmpeg stopped before the end of the source, or the source
+                    # was evicted meanwhile; keep the clip without a source
+                    clip = await self.hass.async_add_executor_job(file_hash, output)
+                    await self.hass.async_add_executor_job(self._cache.put, clip, output, duration)
+        finally:
+            await self.hass.async_add_executor_job(remove_file, output)
+            await self.hass.async_add_executor_job(remove_file, part)
+        return clip, duration
+
+    async def async_prepare_clip(self, clip, trace=None):
+        with span(trace, STAGE_DOWNLOAD):
+            return await self._async_prepare_clip(clip)
+
+    async def _async_prepare_clip(self, clip):
+        mid = self._slots.lookup(clip['hash'])
+        if mid is None:
+            mid = await self._slots.async_acquire(clip['size'])
+            await self._device.async_send("download_user_music", [mid, clip['url']])
+            res = await self._downloads.async_wait(mid, clip['size'], clip['timeout'])
+            if not res:
+                self._slots.discard(mid)
+                _LOGGER.error("download file [" + clip['url'] + "] to gateway failed.")
+                return None
+            self._slots.commit(mid, clip['hash'], clip['size'])
+        return mid
+
+    async def _async_prepare_segment(self, clip, index, trace=None):
+        """Download a message segment into a scratch mid, keeping the slot pool intact."""
+        with span(trace, STAGE_DOWNLOAD):
+            mid = self._slots.lookup(clip['hash'])
+            if mid is not None:
+                return mid
+            mid = await self._slots.async_acquire_scratch(index, clip['size'])
+            await self._device.async_send("download_user_music", [mid, clip['url']])
+            if not await self._downloads.async_wait(mid, clip['size'], clip['timeout']):
+                _LOGGER.error("download file [" + clip['url'] + "] to gateway failed.")
+                return None
+            return mid
+
+    async def async_start_clip(self, mid, volume=None, trace=None):
+        with span(trace, STAGE_PLAYBACK):
+            if volume == None:
+                await self._device.async_send('play_music', [int(mid)])
+            else:    
+                await self._device.async_send('play_music_new', [mid, int(str(volume))])
         return True
-       
-    @asyncio.coroutine
-    def async_play_tts(self, message, **kwargs):
+
+    def async_announce(self, job, policy=POLICY_QUEUE):
+        return self._announcements.async_submit(job, policy)
+
+    async def async_sync_ringtones(self, **kwargs):
+        from miio import DeviceException
+        path = kwargs.get(ATTR_PATH)
+        if not self.hass.config.is_allowed_path(path):
+            _LOGGER.error("%s is not in whitelist_external_dirs.", path)
+            return False
+        clips = await get_library(self.hass).async_scan(path)
+        try:
+            summary = await self._library.async_sync(
+                clips, self._clipUrl, self._downloads,
+                kwargs.get(ATTR_CONCURRENCY, 2), kwargs.get(ATTR_PRUNE, False))
+        except DeviceException as error:
+            _LOGGER.error("Sync ringtones to %s failed: %s", self._name, error)
+            return False
+        _LOGGER.info("%s ringtones: %s", self._name,
+                     ", ".join("%s %d" % (key, len(names)) for key, names in summary.items()))
+        self._library_status = {key: len(names) for key, names in summary.items()}
+        self.hass.bus.async_fire(EVENT_RINGTONES_SYNCED, {'entity_id': self.entity_id, **summary})
+        await self.async_refresh_inventory()
+        self._schedule_update()
+        return not summary['failed']
+
+    async def async_prerender(self, **kwargs):
+        items = [(self.async_render_tts, message) for message in kwargs.get(ATTR_MESSAGES, [])]
+        items += [(self.async_render_vod, url) for url in kwargs.get(ATTR_URLS, [])]
+        # an earlier run that is still going keeps updating its own dict
+        self._prerender = progress = {'total': len(items), 'done': 0, 'failed': []}
+        self.hass.async_create_task(self._async_prerender(items, kwargs.get(ATTR_PRELOAD, False), progress))
+
+    async def _async_prerender(self, items, preload, progress):
+        for render, source in items:
+            try:
+                clip = await render(source)
+                if clip is not None and preload:
+                    mid = await self.async_announce(ft.partial(self.async_prepare_clip, clip))
+                    if mid in (None, False):
+                        clip = None
+            except Exception as error:
+                _LOGGER.error(error)
+                clip = None
+            if clip is None:
+                progress['failed'].append(source)
+            progress['done'] += 1
+            self._schedule_update()
+
+    async def async_play_tts(self, message, **kwargs):
         if message is None:
             _LOGGER.warning("message is not present.")
             return True
-        volume = kwargs.get(ATTR_VOLUME)        
+        volume = kwargs.get(ATTR_VOLUME)
+        return await self.async_announce(
+            ft.partial(self._async_play_tts, message, volume),
+            kwargs.get(ATTR_POLICY, POLICY_QUEUE))
+
+    async def _async_play_tts(self, message, volume):
+        segments = split_message(message)
+        if len(segments) > 1:
+            return await self._async_play_segments(message, segments, volume)
+        trace = Trace('tts', message)
         try:
-            if (self._baidu == None) and (self._apiKey == None or self._secretKey == None):
-                _LOGGER.error("The baidu tts api key is not configured.")
-                return False
-            if self._baidu == None:
-                self._baidu = BaiduTTS(self._hass, self._apiKey, self._secretKey, self._speed, self._pitch, self._volume, self._person)
-            res = yield from self._baidu.generate_tts(message, self._mp3Path)
-            if not res:
-                _LOGGER.error("generate tts failed.")
+            clip = await self.async_render_tts(message, trace)
+            if clip is None:
                 return False
-            if os.path.exists(self._aacPath):
-                os.remove(self._aacPath)
-            ffmpeg = AacConverter(self.hass.data[DATA_FFMPEG].binary, loop=self.hass.loop)
-            result = yield from ffmpeg.convert(self._mp3Path, output=self._aacPath)
-            if (not result) or (not os.path.exists(self._aacPath)) or (os.path.getsize(self._aacPath) < 1):
-                _LOGGER.error("Convert file to aac failed.")
-                return False 
-            self._device.send("delete_user_music", ['99999'])
-            self._device.send("download_user_music", ["99999", self._ttsUrl])
-            _LOGGER.error(self._ttsUrl)
-            index = 0
-            while index < 10:
-                progess = self._device.send("get_download_progress", [])
-                if str(progess) == "['99999:100']":
-                    break
-                index += 1
-                yield from asyncio.sleep(1)
-            if (index >= 10):
-                _LOGGER.error("download tts file [" + self._ttsUrl + "] to gateway failed.")
+            mid = await self.async_prepare_clip(clip, trace)
+            if mid is None:
                 return False
-            if volume == None:
-                self._device.send('play_music', [99999])
-            else:    
-                self._device.send('play_music_new', ["99999", int(str(volume))])
+            await self.async_start_clip(mid, volume, trace)
+            self._latency.record(trace)
             if self._notify:
                 log_msg = "TTS: %s" % message
                 self.hass.components.persistent_notification.async_create(log_msg, title='AC partner TTS', notification_id="99999") 
@@ -445,39 +702,66 @@ class XiaomiMiioRadio(RadioDevice):
             return False
         return True 
        
-    @asyncio.coroutine
-    def async_play_vod(self, url, **kwargs):
+    async def _async_play_segments(self, message, segments, volume):
+        """Play a long message segment by segment while the rest still render."""
+        trace = Trace('tts', message)
+        fanout = asyncio.Semaphore(SEGMENT_FANOUT)
+
+        async def _render(segment, trace):
+            async with fanout:
+                return await self.async_render_tts(segment, trace)
+        # only the first segment is traced, latency is time to first audio
+        renders = [self.hass.async_create_task(_render(segment, trace if index == 0 else None))
+                   for index, segment in enumerate(segments)]
+        try:
+            playing_until = None
+            for index, render in enumerate(renders):
+                first = trace if index == 0 else None
+                clip = await render
+                if clip is None:
+                    return False
+                # the previous segment keeps playing from the other scratch mid
+                mid = await self._async_prepare_segment(clip, index, first)
+                if mid is None:
+                    return False
+                if playing_until is not None:
+                    await asyncio.sleep(max(0, playing_until - time.monotonic()))
+                await self.async_start_clip(mid, volume, first)
+                playing_until = time.monotonic() + clip['duration']
+                if first is not None:
+                    self._latency.record(trace)
+            if self._notify:
+                log_msg = "TTS: %s" % message
+                self.hass.components.persistent_notification.async_create(log_msg, title='AC partner TTS', notification_id="99999")
+        except Exception as error:
+            _LOGGER.error(error)
+            return False
+        finally:
+            for render in renders:
+                render.cancel()
+        return True
+
+    async def async_play_vod(self, url, **kwargs):
         if url is None:
             _LOGGER.warning("message is not present.")
             return True
-        volume = kwargs.get(ATTR_VOLUME)        
+        volume = kwargs.get(ATTR_VOLUME)
+        return await self.async_announce(
+            ft.partial(self._async_play_vod, url, volume),
+            kwargs.get(ATTR_POLICY, POLICY_QUEUE))
+
+    async def _async_play_vod(self, url, volume):
+        trace = Trace('vod', url)
         try:
-            urllib.request.urlretrieve(url, self._mp3Path)
-            if os.path.exists(self._aacPath):
-                os.remove(self._aacPath)
-            ffmpeg = AacConverter(self.hass.data[DATA_FFMPEG].binary, loop=self.hass.loop)
-            result = yield from ffmpeg.convert(self._mp3Path, output=self._aacPath)
-            if (not result) or (not os.path.exists(self._aacPath)) or (os.path.getsize(self._aacPath) < 1):
-                _LOGGER.error("Convert file to aac failed.")
-                return False 
-            self._device.send("delete_user_music", ['99999'])
-            self._device.send("download_user_music", ["99999", self._ttsUrl])
-            index = 0
-            while index < 60:
-                progess = self._device.send("get_download_progress", [])
-                _LOGGER.error(progess)
-                if str(progess) == "['99999:100']":
-                    break
-                index += 1
-                yield from asyncio.sleep(1)
-            if (index >= 60):
-                _LOGGER.error("download tts file to gateway failed.")
+            clip = await self.async_render_vod(url, trace)
+            if clip is None:
                 return False
-            if volume == None:
-                self._device.send('play_music', [99999])
-            else:    
-                self._device.send('play_music_new', ["99999", int(str(volume))])
-            _LOGGER.error("play_vod(%s)" % url) 
+            mid = await self.async_prepare_clip(clip, trace)
+            if mid is None:
+                return False
+            await self.async_start_clip(mid, volume, trace)
+            self._latency.record(trace)
+            _LOGGER.debug("play_vod(%s)" % url) 
             if self._notify:
                 log_msg = "VOD finished."
                 self.hass.components.persistent_notification.async_create(log_msg, title='AC partner TTS', notification_id="99999") 
@@ -485,4 +769,3 @@ class XiaomiMiioRadio(RadioDevice):
             _LOGGER.error(error)
             return False
         return True  
-            
\ No newline at end of file
@@ -0,0 +1,74 @@
+"""
+User-music download tracking for the Xiaomi Gateway Radio.
+
+Polls get_download_progress quickly at first and backs off
+exponentially, so short clips start playing as soon as the gateway
+reports completion while long ones don't flood it with requests.
+"""
+import asyncio
+import logging
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+INITIAL_INTERVAL = 0.1
+MAX_INTERVAL = 1.0
+BACKOFF = 1.6
+STALL_TIMEOUT = 5
+
+
+def parse_progress(result):
+    progress = {}
+    if not isinstance(result, list):
+        result = [result]
+    for item in result:
+        mid, _, percent = str(item).partition(":")
+        try:
+            progress[mid.strip()] = int(percent)
+        except ValueError:
+            continue
+    return progress
+
+
+class DownloadTracker:
+    def __init__(self, device, name):
+        self._device = device
+        self._name = name
+        self.throughput = None
+        self.last_duration = None
+
+    async def async_wait(self, mid, size, timeout):
+        started = time.monotonic()
+        interval = INITIAL_INTERVAL
+        last_percent = None
+        # the gateway may not list the mid while it connects; until the
+        # first percentage only the overall timeout applies
+        last_change = None
+        while time.monotonic() - started < timeout:
+            progress = parse_progress(
+                await self._device.async_send("get_download_progress", []))
+            percent = progress.get(str(mid))
+            now = time.monotonic()
+            if percent is not None and percent >= 100:
+                self._record(size, now - started)
+                return True
+            if percent is not None and percent < 0:
+                _LOGGER.error("%s: download of %s failed (%s).", self._name, mid, percent)
+                return False
+            if percent is not None and percent != last_percent:
+                last_percent = percent
+                last_change = now
+            elif last_change is not None and now - last_change > STALL_TIMEOUT:
+                _LOGGER.error("%s: download of %s stalled at %s%%.", self._name, mid, percent)
+                return False
+            await asyncio.sleep(interval)
+            interval = min(interval * BACKOFF, MAX_INTERVAL)
+        return False
+
+    def _record(self, size, duration):
+        self.last_duration = duration
+        rate = size / max(duration, 0.001)
+        if self.throughput is None:
+            self.throughput = rate
+        else:
+            self.throughput = 0.7 * self.throughput + 0.3 * rate
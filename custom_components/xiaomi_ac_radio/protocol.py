@@ -0,0 +1,303 @@
+"""
+Asyncio transport for the miio protocol used by the Xiaomi Gateway Radio.
+
+python-miio's Device.send blocks on a UDP socket; this speaks the same
+wire format through a datagram endpoint so that a slow or offline gateway
+only delays the coroutine waiting for it, never the event loop.
+
+Every command gets a total time budget shared by its retries, which back
+off with jitter. After repeated failures a circuit breaker fails commands
+immediately and only lets a hello handshake through every probe interval
+until the gateway answers again.
+"""
+import asyncio
+import datetime
+import logging
+import random
+import time
+
+from miio import DeviceException
+
+_LOGGER = logging.getLogger(__name__)
+
+MIIO_PORT = 54321
+HELLO = bytes.fromhex(
+    "21310020ffffffffffffffffffffffffffffffffffffffffffffffffffffffff")
+FAILURE_THRESHOLD = 3
+PROBE_INTERVAL = 30
+RETRY_BACKOFF = 0.2
+# "resource busy", python-miio retries it
+BUSY_ERROR = -30001
+
+
+class MiioProtocol(asyncio.DatagramProtocol):
+    def __init__(self, device):
+        self._device = device
+
+    def datagram_received(self, data, addr):
+        self._device.datagram_received(data)
+
+    def error_received(self, exc):
+        _LOGGER.debug("%s: %s", self._device.host, exc)
+
+    def connection_lost(self, exc):
+        self._device.connection_lost()
+
+
+class CircuitBreaker:
+    def __init__(self, threshold=FAILURE_THRESHOLD, probe_interval=PROBE_INTERVAL):
+        self._threshold = threshold
+        self._probe_interval = probe_interval
+        self.failures = 0
+        self._opened = None
+
+    @property
+    def open(self):
+        return self._opened is not None
+
+    @property
+    def probe_due(self):
+        return self.open and time.monotonic() - self._opened >= self._probe_interval
+
+    def begin_probe(self):
+        # one probe per interval, concurrent callers keep failing fast
+        self._opened = time.monotonic()
+
+    def success(self):
+        self.failures = 0
+        self._opened = None
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self._threshold:
+            self._opened = time.monotonic()
+
+
+class AsyncMiioDevice:
+    def __init__(self, host, token, timeout=5, retry_count=3, budget=None,
+                 probe_interval=PROBE_INTERVAL, resolver=None):
+        self.host = host
+        self._resolver = resolver
+        self.token = bytes.fromhex(token)
+        self._timeout = timeout
+        self._retry_count = retry_count
+        self._budget = budget or timeout * (retry_count + 1)
+        self._breaker = CircuitBreaker(probe_interval=probe_interval)
+        self._transport = None
+        self._device_id = None
+        self._device_ts = None
+        self._hello = None
+        self._lock = asyncio.Lock()
+        self._pending = {}
+        self._id = 0
+
+    @property
+    def in_flight(self):
+        return len(self._pending)
+
+    @property
+    def available(self):
+        return not self._breaker.open
+
+    @property
+    def failures(self):
+        return self._breaker.failures
+
+    @property
+    def device_id(self):
+        return None if self._device_id is None else bytes(self._device_id).hex()
+
+    def set_host(self, host):
+        """Talk to host from now on, e.g. after DHCP moved the gateway."""
+        _LOGGER.warning("%s moved to %s", self.host, host)
+        self.close()
+        self._device_id = None
+        self.host = host
+
+    async def _async_connect(self):
+        if self._transport is None:
+            loop = asyncio.get_running_loop()
+            self._transport, _ = await loop.create_datagram_endpoint(
+                lambda: MiioProtocol(self), remote_addr=(self.host, MIIO_PORT))
+
+    async def async_handshake(self, timeout=None):
+        try:
+            await self._async_hello(timeout)
+        except asyncio.TimeoutError:
+            raise DeviceException("Unable to discover the device %s" % self.host)
+
+    async def _async_hello(self, timeout=None):
+        async with self._lock:
+            if self._device_id is not None:
+                return
+            await self._async_connect()
+            self._hello = asyncio.get_running_loop().create_future()
+            self._transport.sendto(HELLO)
+            try:
+                await asyncio.wait_for(self._hello, timeout or self._timeout)
+            finally:
+                self._hello = None
+
+    def datagram_received(self, data):
+        from construct.core import ChecksumError
+        from miio.protocol import Message
+        try:
+            msg = Message.parse(data, token=self.token)
+        except ChecksumError:
+            # hellos carry no checksum, a reply that fails it was sealed with another token
+            _LOGGER.error("%s: got checksum error which indicates use of an invalid token", self.host)
+            self._fail_pending(DeviceException(
+                "Got checksum error which indicates use of an invalid token for %s" % self.host))
+            return
+        except Exception as ex:
+            _LOGGER.debug("%s: unable to parse packet: %s", self.host, ex)
+            return
+        header = msg.header.value
+        if len(data) == 32:
+            self._device_id = header.device_id
+            self._device_ts = header.ts
+            if self._hello is not None and not self._hello.done():
+                self._hello.set_result(True)
+            return
+        payload = msg.data.value
+        if not isinstance(payload, dict):
+            return
+        self._device_ts = header.ts
+        future = self._pending.pop(payload.get("id"), None)
+        if future is not None and not future.done():
+            if not self._pending:
+                # continue from the id the device answered, like python-miio
+                self._id = payload["id"]
+            future.set_result(payload)
+
+    def _fail_pending(self, exception):
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(exception)
+        self._pending.clear()
+
+    def connection_lost(self):
+        self._transport = None
+        self._device_id = None
+        self._fail_pending(DeviceException("Connection lost"))
+
+    def _next_id(self):
+        """Return the next request id, wrapping at 9999 like python-miio."""
+        while True:
+            self._id += 1
+            if self._id >= 9999:
+                self._id = 1
+            if self._id not in self._pending:
+                return self._id
+
+    async def _async_send_once(self, command, parameters, timeout):
+        from miio.protocol import Message
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        # a lost hello times out like a lost reply and is retried the same way
+        await self._async_hello(timeout)
+        request_id = self._next_id()
+        request = {"id": request_id, "method": command, "params": parameters}
+        header = {
+            "length": 0,
+            "unknown": 0x00000000,
+            "device_id": self._device_id,
+            "ts": self._device_ts + datetime.timedelta(seconds=1),
+        }
+        msg = {"data": {"value": request}, "header": {"value": header}, "checksum": 0}
+        future = loop.create_future()
+        self._pending[request_id] = future
+        try:
+            self._transport.sendto(Message.build(msg, token=self.token))
+            return await asyncio.wait_for(future, max(0, deadline - loop.time()))
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def async_probe(self):
+        self._breaker.begin_probe()
+        self._device_id = None
+        try:
+            await self.async_handshake()
+        except DeviceException:
+            host = await self._async_resolve()
+            if host is None:
+                self._breaker.failure()
+                raise
+            self.set_host(host)
+            try:
+                await self.async_handshake()
+            except DeviceException:
+                self._breaker.failure()
+                raise
+        _LOGGER.info("%s is responding again", self.host)
+        self._breaker.success()
+
+    async def _async_resolve(self):
+        if self._resolver is None:
+            return None
+        try:
+            host = await self._resolver()
+        except OSError as ex:
+            _LOGGER.debug("%s: discovery failed: %s", self.host, ex)
+            return None
+        return host if host != self.host else None
+
+    async def async_send(self, command, parameters=None, retry_count=None):
+        if parameters is None:
+            parameters = []
+        if retry_count is None:
+            retry_count = self._retry_count
+        if self._breaker.open:
+            if not self._breaker.probe_due:
+                raise DeviceException("%s is unavailable" % self.host)
+            await self.async_probe()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self._budget
+        busy = None
+        for attempt in range(retry_count + 1):
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                payload = await self._async_send_once(
+                    command, parameters, min(self._timeout, remaining))
+            except asyncio.TimeoutError:
+                _LOGGER.debug("%s: %s timed out (attempt %s)", self.host, command, attempt + 1)
+                self._device_id = None
+                self._id += 100
+                busy = None
+            except DeviceException:
+                self._async_failed()
+                raise
+            else:
+                self._breaker.success()
+                error = payload.get("error")
+                if error is None:
+                    return payload.get("result")
+                if not isinstance(error, dict) or error.get("code") != BUSY_ERROR:
+                    raise DeviceException("%s: %s" % (command, error))
+                _LOGGER.debug("%s: %s is busy (attempt %s)", self.host, command, attempt + 1)
+                busy = error
+            if attempt < retry_count:
+                backoff = RETRY_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5)
+                await asyncio.sleep(min(backoff, max(0, deadline - loop.time())))
+        if busy is not None:
+            raise DeviceException("%s: unable to recover failed command: %s" % (command, busy))
+        self._async_failed()
+        raise DeviceException("No response from the device %s" % self.host)
+
+    def _async_failed(self):
+        was_open = self._breaker.open
+        self._breaker.failure()
+        if self._breaker.open and not was_open:
+            _LOGGER.warning("%s failed %s times in a row, marking it unavailable",
+                            self.host, self._breaker.failures)
+
+    async def async_info(self):
+        from miio.device import DeviceInfo
+        return DeviceInfo(await self.async_send("miIO.info"))
+
+    def close(self):
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
@@ -0,0 +1,113 @@
+"""
+Local audio endpoint for the Xiaomi Gateway Radio.
+
+Gateways download clips from this view instead of the static www folder.
+Recently used clips are held in a bounded in-memory store; anything else
+is read back from the on-disk audio caches.
+"""
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from aiohttp import hdrs, web
+
+from homeassistant.components.http import HomeAssistantView
+
+from custom_components.xiaomi_ac_radio.cache import DATA_AUDIO_CACHES
+
+_LOGGER = logging.getLogger(__name__)
+
+DATA_CLIP_STORE = 'xiaomi_ac_radio_clip_store'
+CLIP_URL = '/api/xiaomi_ac_radio/clip/{}.aac'
+CONTENT_TYPE_AAC = 'audio/aac'
+
+
+def get_clip_store(hass, max_bytes=16 * 1024 * 1024):
+    if DATA_CLIP_STORE not in hass.data:
+        store = hass.data[DATA_CLIP_STORE] = ClipStore(max_bytes)
+        hass.http.register_view(ClipView(hass, store))
+    return hass.data[DATA_CLIP_STORE]
+
+
+class ClipStore:
+    def __init__(self, max_bytes):
+        self._max_bytes = max_bytes
+        self._clips = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data = self._clips.get(key)
+            if data is not None:
+                self._clips.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        with self._lock:
+            old = self._clips.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._clips[key] = data
+            self._size += len(data)
+            while len(self._clips) > 1 and self._size > self._max_bytes:
+                _, evicted = self._clips.popitem(last=False)
+                self._size -= len(evicted)
+
+    def load(self, key, path):
+        data = self.get(key)
+        if data is None and os.path.exists(path):
+            with open(path, "rb") as fp:
+                data = fp.read()
+            self.put(key, data)
+        return data
+
+
+class ClipView(HomeAssistantView):
+    url = '/api/xiaomi_ac_radio/clip/{clip}'
+    name = 'api:xiaomi_ac_radio:clip'
+    # the gateway can't authenticate; clip names are content hashes
+    requires_auth = False
+
+    def __init__(self, hass, store):
+        self._hass = hass
+        self._store = store
+
+    def _load(self, key):
+        data = self._store.get(key)
+        if data is not None:
+            return data
+        for cache in self._hass.data.get(DATA_AUDIO_CACHES, {}).values():
+            data = self._store.load(key, cache.file_path(key))
+            if data is not None:
+                return data
+        return None
+
+    async def get(self, request, clip):
+        key = os.path.splitext(os.path.basename(clip))[0]
+        data = await self._hass.async_add_executor_job(self._load, key)
+        if data is None:
+            return web.Response(status=404)
+        etag = '"%s"' % key
+        headers = {
+            hdrs.ETAG: etag,
+            hdrs.ACCEPT_RANGES: 'bytes',
+            hdrs.CACHE_CONTROL: 'max-age=3600',
+        }
+        if request.headers.get(hdrs.IF_NONE_MATCH) == etag:
+            return web.Response(status=304, headers=headers)
+        try:
+            rng = request.http_range
+        except ValueError:
+            rng = slice(None, None)
+        if rng.start is None and rng.stop is None:
+            return web.Response(body=data, headers=headers,
+                                content_type=CONTENT_TYPE_AAC)
+        start, stop, _ = rng.indices(len(data))
+        if start >= stop:
+            headers[hdrs.CONTENT_RANGE] = 'bytes */%d' % len(data)
+            return web.Response(status=416, headers=headers)
+        headers[hdrs.CONTENT_RANGE] = 'bytes %d-%d/%d' % (start, stop - 1, len(data))
+        return web.Response(status=206, body=data[start:stop], headers=headers,
+                            content_type=CONTENT_TYPE_AAC)
@@ -0,0 +1,119 @@
+"""
+Gateway user-music slot pool for the Xiaomi Gateway Radio.
+
+Remembers which audio clip lives in which user-music mid on the gateway
+so recurring clips can be played without downloading them again.
+"""
+import logging
+from collections import OrderedDict
+
+from homeassistant.helpers.storage import Store
+
+_LOGGER = logging.getLogger(__name__)
+
+STORAGE_VERSION = 1
+STORAGE_KEY = 'xiaomi_ac_radio.slots_{}'
+SLOT_BASE = 99900
+MAX_SLOTS = 98
+# one-off clips such as message segments alternate between these, outside the pool
+SCRATCH_MIDS = [str(SLOT_BASE + MAX_SLOTS), str(SLOT_BASE + MAX_SLOTS + 1)]
+
+
+def free_space(result):
+    if isinstance(result, list):
+        result = result[0] if result else 0
+    try:
+        return int(result)
+    except (TypeError, ValueError):
+        return 0
+
+
+class GatewaySlots:
+    def __init__(self, hass, device, unique_id, slot_count=10):
+        self._hass = hass
+        self._device = device
+        self._slot_count = slot_count
+        self._slots = OrderedDict()
+        self._loaded = False
+        self._store = Store(hass, STORAGE_VERSION,
+                            STORAGE_KEY.format(str(unique_id).replace(":", "")))
+
+    @property
+    def resident(self):
+        return len(self._slots)
+
+    def _all_mids(self):
+        return [str(SLOT_BASE + i) for i in range(self._slot_count)]
+
+    async def async_load(self):
+        """Read the stored slot map, before the entity takes announcements."""
+        data = await self._store.async_load() or {}
+        self._slots.clear()
+        for mid, slot in data.get("slots", []):
+            if mid in self._all_mids():
+                self._slots[mid] = slot
+        self._loaded = True
+
+    async def async_verify(self):
+        """Forget slots the gateway no longer holds."""
+        result = await self._device.async_send("get_music_info", [3])
+        present = set()
+        for music in result.get("list", []) if isinstance(result, dict) else []:
+            present.add(str(music.get("mid")))
+        missing = [mid for mid in self._slots if mid not in present]
+        for mid in missing:
+            del self._slots[mid]
+        if missing:
+            _LOGGER.debug("User music %s is gone from the gateway", missing)
+            self._save()
+
+    def _save(self):
+        # an early save would replace the stored map with an empty one
+        if not self._loaded:
+            return
+        self._store.async_delay_save(
+            lambda: {"slots": list(self._slots.items())}, 1)
+
+    def lookup(self, clip):
+        for mid, slot in self._slots.items():
+            if slot["hash"] == clip:
+                self._slots.move_to_end(mid)
+                self._save()
+                return mid
+        return None
+
+    async def _async_delete(self, mid):
+        await self._device.async_send("delete_user_music", [mid])
+        return self._slots.pop(mid, {}).get("size", 0)
+
+    async def _async_make_room(self, size):
+        space = free_space(await self._device.async_send("get_music_free_space", []))
+        while space < size and self._slots:
+            evicted = next(iter(self._slots))
+            _LOGGER.debug("Evict user music %s to free space", evicted)
+            space += await self._async_delete(evicted)
+
+    async def async_acquire(self, size):
+        free = [mid for mid in self._all_mids() if mid not in self._slots]
+        mid = free[0] if free else next(iter(self._slots))
+        await self._async_delete(mid)
+        await self._async_make_room(size)
+        self._save()
+        return mid
+
+    async def async_acquire_scratch(self, index, size):
+        """Return the scratch mid for the index-th one-off clip, never committed."""
+        mid = SCRATCH_MIDS[index % len(SCRATCH_MIDS)]
+        await self._device.async_send("delete_user_music", [mid])
+        await self._async_make_room(size)
+        self._save()
+        return mid
+
+    def commit(self, mid, clip, size):
+        self._slots[mid] = {"hash": clip, "size": size}
+        self._slots.move_to_end(mid)
+        self._save()
+
+    def discard(self, mid):
+        self._slots.pop(mid, None)
+        self._save()
@@ -0,0 +1,78 @@
+"""
+Announcement latency statistics for the Xiaomi Gateway Radio.
+
+Each TTS/VOD request carries a Trace that records how long every stage
+took; finished traces are aggregated per entity into percentiles.
+"""
+import logging
+import time
+from collections import deque
+from contextlib import contextmanager
+
+_LOGGER = logging.getLogger(__name__)
+
+STAGE_TOKEN = 'token'
+STAGE_SYNTHESIS = 'synthesis'
+STAGE_FETCH = 'fetch'
+STAGE_TRANSCODE = 'transcode'
+STAGE_DOWNLOAD = 'download'
+STAGE_PLAYBACK = 'playback'
+STAGE_TOTAL = 'total'
+STAGES = (STAGE_TOKEN, STAGE_SYNTHESIS, STAGE_FETCH, STAGE_TRANSCODE,
+          STAGE_DOWNLOAD, STAGE_PLAYBACK, STAGE_TOTAL)
+PERCENTILES = (50, 90, 99)
+
+
+@contextmanager
+def span(trace, stage):
+    if trace is None:
+        yield
+        return
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        trace.add(stage, time.monotonic() - started)
+
+
+class Trace:
+    def __init__(self, kind, source):
+        self.kind = kind
+        self.source = source
+        self.spans = {}
+        self._started = time.monotonic()
+
+    def add(self, stage, duration):
+        self.spans[stage] = self.spans.get(stage, 0.0) + duration
+
+    def finish(self):
+        self.spans[STAGE_TOTAL] = time.monotonic() - self._started
+
+
+class LatencyStats:
+    def __init__(self, name, size=100, debug=False):
+        self._name = name
+        self._debug = debug
+        self._samples = {stage: deque(maxlen=size) for stage in STAGES}
+
+    def record(self, trace):
+        trace.finish()
+        for stage, duration in trace.spans.items():
+            self._samples[stage].append(duration)
+        if self._debug:
+            _LOGGER.debug("%s %s(%s): %s", self._name, trace.kind, trace.source,
+                          ", ".join("%s=%dms" % (stage, duration * 1000)
+                                    for stage, duration in trace.spans.items()))
+
+    @property
+    def percentiles(self):
+        result = {}
+        for stage, samples in self._samples.items():
+            if not samples:
+                continue
+            ordered = sorted(samples)
+            result[stage] = {
+                'p%d' % pct: int(ordered[min(len(ordered) - 1, len(ordered) * pct // 100)] * 1000)
+                for pct in PERCENTILES
+            }
+        return result
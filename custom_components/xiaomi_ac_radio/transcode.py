@@ -0,0 +1,215 @@
+"""
+Streaming AAC transcoding for the Xiaomi Gateway Radio.
+
+Source audio is fed to ffmpeg's stdin as it arrives over HTTP and ffmpeg
+writes the AAC file as it encodes, so no intermediate file is needed.
+Jobs from every entity share one bounded pool of transcoding workers.
+
+Speech is encoded mono at a low bitrate and music in stereo; both get
+leading silence trimmed and loudness normalized in the same pass, which
+keeps the files the gateway has to download small. Only speech also has
+its trailing silence trimmed, that needs the whole clip in memory.
+"""
+import asyncio
+import logging
+import os
+import re
+import subprocess
+import time
+
+from homeassistant.const import EVENT_HOMEASSISTANT_STOP
+
+_LOGGER = logging.getLogger(__name__)
+
+DATA_TRANSCODE_POOL = 'xiaomi_ac_radio_transcode_pool'
+
+CHUNK_SIZE = 64 * 1024
+PROFILE_SPEECH = 'speech'
+PROFILE_MUSIC = 'music'
+TRIM_SILENCE = 'silenceremove=start_periods=1:start_threshold=-50dB:start_silence=0.1'
+LOUDNORM = 'loudnorm=I=-16:TP=-1.5:LRA=11'
+# areverse buffers the whole input, fine for a TTS clip but not for a
+# streamed VOD source of unknown length
+SPEECH_FILTER = ','.join([TRIM_SILENCE, 'areverse', TRIM_SILENCE, 'areverse', LOUDNORM])
+MUSIC_FILTER = ','.join([TRIM_SILENCE, LOUDNORM])
+PROFILES = {
+    PROFILE_SPEECH: {'bitrate': 32000, 'rate': 24000, 'channels': 1, 'filter': SPEECH_FILTER},
+    PROFILE_MUSIC: {'bitrate': 64000, 'rate': 48000, 'channels': 2, 'filter': MUSIC_FILTER},
+}
+# what every clip used to be encoded with, the baseline for bytes saved
+LEGACY_BITRATE = 64000
+STATS_TIME = re.compile(rb'time=(\d+):(\d+):(\d+(?:\.\d+)?)')
+
+
+def aac_command(profile):
+    settings = PROFILES[profile]
+    return [
+        "-vn",
+        "-af",
+        settings['filter'],
+        "-c:a",
+        "aac",
+        "-strict",
+        "-2",
+        "-b:a",
+        str(settings['bitrate']),
+        "-ar",
+        str(settings['rate']),
+        "-ac",
+        str(settings['channels']),
+        "-y"
+    ]
+
+
+def clip_duration(size, profile):
+    return size * 8 / PROFILES[profile]['bitrate']
+
+
+async def async_stream_convert(binary, chunks, output, profile=PROFILE_MUSIC, timeout=60):
+    """Encode chunks into output, return the clip stats or False on failure."""
+    started = time.monotonic()
+    proc = await asyncio.create_subprocess_exec(
+        binary, "-hide_banner", "-i", "pipe:0", *aac_command(profile), output,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE)
+    fed = 0
+
+    async def _feed():
+        nonlocal fed
+        try:
+            async for chunk in chunks:
+                fed += len(chunk)
+                proc.stdin.write(chunk)
+                await proc.stdin.drain()
+        finally:
+            proc.stdin.close()
+        return await proc.wait()
+
+    async def _stats():
+        # only the last progress line matters, it holds the output duration
+        tail = b''
+        while True:
+            data = await proc.stderr.read(CHUNK_SIZE)
+            if not data:
+                return tail
+            tail = (tail + data)[-1024:]
+    stats = asyncio.get_running_loop().create_task(_stats())
+
+    try:
+        code = await asyncio.wait_for(_feed(), timeout)
+    except asyncio.TimeoutError:
+        _LOGGER.error("Timeout convert audio file.")
+        proc.kill()
+        return False
+    except asyncio.CancelledError:
+        proc.kill()
+        raise
+    except (BrokenPipeError, ConnectionResetError):
+        _LOGGER.error("FFmpeg exited while reading the audio stream.")
+        code = await proc.wait()
+    finally:
+        if proc.returncode is None:
+            stats.cancel()
+    if code != 0:
+        _LOGGER.error("FFmpeg exited with code %s.", code)
+        stats.cancel()
+        return False
+    matches = STATS_TIME.findall(await stats)
+    size = os.path.getsize(output) if os.path.exists(output) else 0
+    if matches:
+        hours, minutes, seconds = matches[-1]
+        duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    else:
+        duration = clip_duration(size, profile)
+    return {
+        'profile': profile,
+        'input': fed,
+        'size': size,
+        'duration': round(duration, 2),
+        'saved': max(0, int(duration * LEGACY_BITRATE / 8) - size),
+        'encode': round(time.monotonic() - started, 3),
+    }
+
+
+def get_transcode_pool(hass, workers=2, timeout=60):
+    if DATA_TRANSCODE_POOL not in hass.data:
+        pool = hass.data[DATA_TRANSCODE_POOL] = TranscodePool(hass, workers, timeout)
+        hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, pool.async_stop)
+    return hass.data[DATA_TRANSCODE_POOL]
+
+
+class TranscodePool:
+    def __init__(self, hass, workers=2, timeout=60):
+        self._hass = hass
+        self._size = workers
+        self._timeout = timeout
+        self._queue = asyncio.Queue()
+        self._workers = []
+        self.active = 0
+        self.completed = 0
+        self.failed = 0
+        self.last_wait = 0.0
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    @property
+    def metrics(self):
+        return {
+            'transcode_queue': self.queue_depth,
+            'transcode_active': self.active,
+            'transcode_completed': self.completed,
+            'transcode_failed': self.failed,
+            'transcode_wait': round(self.last_wait, 3),
+        }
+
+    async def async_submit(self, job, timeout=None):
+        """Queue a coroutine function that runs one transcode, return its result."""
+        if not self._workers:
+            self._workers = [self._hass.loop.create_task(self._async_worker())
+                             for _ in range(self._size)]
+        future = self._hass.loop.create_future()
+        await self._queue.put((job, timeout or self._timeout, future, time.monotonic()))
+        return await future
+
+    async def _async_worker(self):
+        while True:
+            job, timeout, future, queued = await self._queue.get()
+            if future.cancelled():
+                self._queue.task_done()
+                continue
+            self.last_wait = time.monotonic() - queued
+            self.active += 1
+            task = self._hass.loop.create_task(asyncio.wait_for(job(), timeout))
+            # a cancelled caller cancels its job, which kills the ffmpeg process
+            future.add_done_callback(lambda done, task=task: done.cancelled() and task.cancel())
+            try:
+                result = await task
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    task.cancel()
+                    raise
+                _LOGGER.debug("Transcode job cancelled by its caller.")
+                continue
+            except asyncio.TimeoutError:
+                _LOGGER.error("Transcode job timed out after %ss.", timeout)
+                result = False
+            except Exception as ex:  # pylint: disable=broad-except
+                _LOGGER.error(ex)
+                result = False
+            finally:
+                self.active -= 1
+                self._queue.task_done()
+            if result:
+                self.completed += 1
+            else:
+                self.failed += 1
+            if not future.done():
+                future.set_result(result)
+
+    async def async_stop(self, event=None):
+        for worker in self._workers:
+            worker.cancel()
+        self._workers = []
@@ -0,0 +1,293 @@
+"""
+TTS engines for the Xiaomi Gateway Radio.
+
+Every engine turns a message into a stream of audio chunks that is fed
+to ffmpeg; an entity tries its engines in the configured order.
+
+Long messages are split at sentence boundaries so that the segments can
+be synthesized concurrently and the first one played while the rest are
+still rendering.
+
+For Baidu, one token manager is shared per api_key by every entity; it
+refreshes the access token ahead of expiry and makes concurrent callers
+wait on a single refresh. All requests go through Home Assistant's pooled
+aiohttp session.
+"""
+import asyncio
+import io
+import logging
+import math
+import re
+import shlex
+import struct
+import subprocess
+import time
+import urllib
+import wave
+
+from homeassistant.helpers.aiohttp_client import async_get_clientsession
+
+from custom_components.xiaomi_ac_radio.cache import cache_key
+from custom_components.xiaomi_ac_radio.stats import STAGE_TOKEN, span
+from custom_components.xiaomi_ac_radio.transcode import CHUNK_SIZE
+
+_LOGGER = logging.getLogger(__name__)
+
+TOKEN_INTERFACE = 'https://openapi.baidu.com/oauth/2.0/token'
+TEXT2AUDIO_INTERFACE = 'http://tsn.baidu.com/text2audio'
+DATA_BAIDU_TOKENS = 'xiaomi_ac_radio_baidu_tokens'
+REFRESH_MARGIN = 24 * 3600
+TOKEN_ERRORS = (502, 3302)
+
+ENGINE_BAIDU = 'baidu'
+ENGINE_COMMAND = 'command'
+ENGINE_FAKE = 'fake'
+TTS_ENGINES = [ENGINE_BAIDU, ENGINE_COMMAND, ENGINE_FAKE]
+DEFAULT_TTS_COMMAND = 'espeak-ng -v cmn --stdout {message}'
+SEGMENT_LENGTH = 120
+SENTENCE_END = re.compile(r'(?<=[。！？；!?;\n])|(?<=[.](?=\s))')
+
+
+def split_message(message, limit=SEGMENT_LENGTH):
+    """Split message into segments of whole sentences up to limit chars."""
+    if len(message) <= limit:
+        return [message]
+    segments = []
+    current = ''
+    for sentence in SENTENCE_END.split(message):
+        while len(sentence) > limit:
+            # a sentence longer than limit, cut at a comma or hard at limit
+            cut = max(sentence.rfind(sep, 0, limit) for sep in '，,、 ') + 1 or limit
+            if current:
+                segments.append(current)
+                current = ''
+            segments.append(sentence[:cut])
+            sentence = sentence[cut:]
+        if len(current) + len(sentence) > limit:
+            segments.append(current)
+            current = ''
+        current += sentence
+    if current:
+        segments.append(current)
+    return [segment.strip() for segment in segments if segment.strip()]
+
+
+def get_token_manager(hass, apiKey, secretKey):
+    managers = hass.data.setdefault(DATA_BAIDU_TOKENS, {})
+    if apiKey not in managers:
+        managers[apiKey] = BaiduTokenManager(hass, apiKey, secretKey)
+    return managers[apiKey]
+
+
+class BaiduTokenManager:
+    def __init__(self, hass, apiKey, secretKey):
+        self._hass = hass
+        self.apiKey = apiKey
+        self.secretKey = secretKey
+        self._token = None
+        self._expires = 0
+        self._refresh = None
+
+    async def async_get_token(self):
+        remaining = self._expires - time.monotonic()
+        if self._token is not None and remaining > REFRESH_MARGIN:
+            return self._token
+        if self._token is not None and remaining > 0:
+            self._async_start_refresh()
+            return self._token
+        return await asyncio.shield(self._async_start_refresh())
+
+    def invalidate(self, token):
+        if self._token == token:
+            self._token = None
+
+    def _async_start_refresh(self):
+        if self._refresh is None or self._refresh.done():
+            self._refresh = self._hass.async_create_task(self._async_fetch())
+        return self._refresh
+
+    async def _async_fetch(self):
+        try:
+            session = async_get_clientsession(self._hass)
+            async with session.get(TOKEN_INTERFACE, params={'grant_type': 'client_credentials',
+                                                            'client_id': self.apiKey,
+                                                            'client_secret': self.secretKey}) as resp:
+                if resp.status != 200:
+                    _LOGGER.error('Get ToKen Http Error status_code:%s' % resp.status)
+                    return self._token
+                tokenJson = await resp.json(content_type=None)
+            if not 'access_token' in tokenJson:
+                _LOGGER.error('Get ToKen Json Error!')
+                return self._token
+            self._token = tokenJson['access_token']
+            self._expires = time.monotonic() + int(tokenJson.get('expires_in', 0))
+            return self._token
+        except Exception as ex:
+            _LOGGER.error(ex)
+            return self._token
+
+
+class AudioStream:
+    def __init__(self, chunks, close=None):
+        self.chunks = chunks
+        self._close = close
+
+    async def async_close(self):
+        if self._close is not None:
+            res = self._close()
+            if asyncio.iscoroutine(res):
+                await res
+
+
+class TTSEngine:
+    name = None
+
+    def cache_key(self, message):
+        raise NotImplementedError()
+
+    async def async_open(self, message, trace=None):
+        """Return an AudioStream for message, or None when synthesis failed."""
+        raise NotImplementedError()
+
+
+class BaiduTTS(TTSEngine):
+    name = ENGINE_BAIDU
+
+    def __init__(self, hass, apiKey, secretKey, speed = 5, pitch = 5, volume = 15, person = 0):
+        self._hass = hass
+        self._tokens = get_token_manager(hass, apiKey, secretKey)
+        self.speed = speed
+        self.pitch = pitch
+        self.volume = volume
+        self.person = person
+
+    def cache_key(self, message):
+        return cache_key(message, self.speed, self.pitch, self.volume, self.person)
+
+    async def async_open(self, message, trace=None):
+        resp = await self.open_tts(message, trace=trace)
+        if resp is None:
+            return None
+        return AudioStream(resp.content.iter_chunked(CHUNK_SIZE), resp.release)
+
+    async def open_tts(self, message, retry=True, trace=None):
+        try:
+            with span(trace, STAGE_TOKEN):
+                token = await self._tokens.async_get_token()
+            if token == None:
+                _LOGGER.error('get_tts_audio Self.ToKen is nil')
+                return None
+            session = async_get_clientsession(self._hass)
+            resp = await session.get(TEXT2AUDIO_INTERFACE, params={'tex': urllib.parse.quote(message),
+                                                                   'lan': 'zh',
+                                                                   'tok': token,
+                                                                   'ctp': '1',
+                                                                   'aue': 6,
+                                                                   'cuid': 'HomeAssistant',
+                                                                   'spd': self.speed,
+                                                                   'pit': self.pitch,
+                                                                   'vol': self.volume,
+                                                                   'per': self.person})
+            status = resp.status
+            if status == 200 and resp.content_type == 'application/json':
+                # errors come back as json with http status 200
+                error = await resp.json()
+                status = error.get('err_no', -1)
+                _LOGGER.debug('Text2Audio Error: %s', error)
+            if status != 200 or resp.content_type == 'application/json':
+                resp.release()
+            if status in TOKEN_ERRORS:
+                self._tokens.invalidate(token)
+                if not retry:
+                    _LOGGER.error('Text2Audio Error:%s TokenVerificationError' % status)
+                    return None
+                _LOGGER.warning('Text2Audio Error:%s TokenVerificationError, Now Get Token!' % status)
+                return await self.open_tts(message, False, trace)
+            if status == 500:
+                _LOGGER.error('Text2Audio Error:500 Not Support.')
+                return None
+            if status == 501:
+                _LOGGER.error('Text2Audio Error:501 Params Error')
+                return None
+            if status == 503:
+                _LOGGER.error('Text2Audio Error:503 Composite Error.')
+                return None
+            if status != 200:
+                _LOGGER.error('get_tts_audio Http Error status_code:%s' % status)
+                return None
+            return resp
+        except Exception as ex:
+            _LOGGER.error(ex)
+            return None
+
+
+class CommandTTS(TTSEngine):
+    """Run a local synthesizer that writes audio to stdout."""
+    name = ENGINE_COMMAND
+
+    def __init__(self, command=DEFAULT_TTS_COMMAND):
+        self._command = command
+
+    def cache_key(self, message):
+        return cache_key(self.name, self._command, message)
+
+    async def async_open(self, message, trace=None):
+        args = [arg.format(message=message) for arg in shlex.split(self._command)]
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except OSError as ex:
+            _LOGGER.error("Start tts command failed: %s", ex)
+            return None
+        try:
+            first = await proc.stdout.read(CHUNK_SIZE)
+        except BaseException:
+            # cancelled before the stream and its close hook exist
+            proc.kill()
+            await proc.wait()
+            raise
+        if not first:
+            _LOGGER.error("TTS command exited with code %s.", await proc.wait())
+            return None
+
+        async def _chunks():
+            yield first
+            while True:
+                chunk = await proc.stdout.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+        def _close():
+            if proc.returncode is None:
+                proc.kill()
+        return AudioStream(_chunks(), _close)
+
+
+class FakeTTS(TTSEngine):
+    """Offline engine producing a quiet tone whose length follows the message."""
+    name = ENGINE_FAKE
+    RATE = 16000
+    # one 400Hz period at about -30dBFS, plain silence would be trimmed away
+    PERIOD = b"".join(struct.pack("<h", int(1000 * math.sin(2 * math.pi * i / 40)))
+                      for i in range(40))
+
+    def cache_key(self, message):
+        return cache_key(self.name, message)
+
+    def render(self, message):
+        buffer = io.BytesIO()
+        with wave.open(buffer, "wb") as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(self.RATE)
+            wav.writeframes(self.PERIOD * (self.RATE // 5 // 40) * max(len(message), 1))
+        return buffer.getvalue()
+
+    async def async_open(self, message, trace=None):
+        data = self.render(message)
+
+        async def _chunks():
+            for index in range(0, len(data), CHUNK_SIZE):
+                yield data[index:index + CHUNK_SIZE]
+        return AudioStream(_chunks())
@@ -0,0 +1,192 @@
+"""
+On-disk cache of play_vod sources for the Xiaomi Gateway Radio.
+
+Every entry keeps the downloaded source, its ETag/Last-Modified validators
+and the AAC transcoded from it side by side. A repeated URL is revalidated
+with a conditional GET; when the server answers 304 the cached AAC is used
+without downloading or encoding anything. Entries are evicted in
+least-recently-used order once the byte limit is reached.
+"""
+import json
+import logging
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+
+from custom_components.xiaomi_ac_radio.cache import (
+    AUDIO_EXT, DATA_AUDIO_CACHES, INDEX_FILE, cache_key, file_hash, remove_file)
+from custom_components.xiaomi_ac_radio.transcode import CHUNK_SIZE
+
+_LOGGER = logging.getLogger(__name__)
+
+SOURCE_EXT = '.src'
+PART_EXT = '.part'
+
+
+def get_source_cache(hass, path, max_bytes):
+    caches = hass.data.setdefault(DATA_AUDIO_CACHES, {})
+    if path not in caches:
+        # registered with the audio caches so the clip view finds the AAC
+        caches[path] = SourceCache(path, max_bytes)
+    return caches[path]
+
+
+async def async_tee(hass, chunks, path, done):
+    """Pass chunks through while writing them to path; done is set at the end."""
+    fp = await hass.async_add_executor_job(open, path, "wb")
+    try:
+        async for chunk in chunks:
+            await hass.async_add_executor_job(fp.write, chunk)
+            yield chunk
+        done.append(True)
+    finally:
+        await hass.async_add_executor_job(fp.close)
+
+
+async def async_read(hass, path):
+    fp = await hass.async_add_executor_job(open, path, "rb")
+    try:
+        while True:
+            chunk = await hass.async_add_executor_job(fp.read, CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        await hass.async_add_executor_job(fp.close)
+
+
+class SourceCache:
+    def __init__(self, path, max_bytes=100 * 1024 * 1024):
+        self._path = path
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._loaded = False
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def entries(self):
+        return len(self._entries)
+
+    @property
+    def size_bytes(self):
+        return sum(entry['size'] for entry in self._entries.values())
+
+    def file_path(self, clip):
+        return os.path.join(self._path, clip + AUDIO_EXT)
+
+    def source_path(self, url):
+        return os.path.join(self._path, cache_key(url) + SOURCE_EXT)
+
+    def part_path(self, url):
+        """Return a new path for one download of url."""
+        return "%s.%s%s" % (self.source_path(url), uuid.uuid4().hex[:12], PART_EXT)
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        os.makedirs(self._path, exist_ok=True)
+        try:
+            with open(os.path.join(self._path, INDEX_FILE), "r") as fp:
+                index = json.load(fp)
+        except (OSError, ValueError):
+            index = []
+        for key, entry in index:
+            if os.path.exists(os.path.join(self._path, key + SOURCE_EXT)):
+                self._entries[key] = entry
+
+    def _save(self):
+        try:
+            with open(os.path.join(self._path, INDEX_FILE), "w") as fp:
+                json.dump(list(self._entries.items()), fp)
+        except OSError as ex:
+            _LOGGER.warning("Save vod cache index failed: %s", ex)
+
+    def _remove(self, key, entry):
+        remove_file(os.path.join(self._path, key + SOURCE_EXT))
+        self._remove_clip(entry['clip'])
+
+    def _remove_clip(self, clip):
+        # two urls may serve the same audio and share one AAC
+        if not any(other['clip'] == clip for other in self._entries.values()):
+            remove_file(self.file_path(clip))
+
+    def _evict(self):
+        while len(self._entries) > 1 and self.size_bytes > self._max_bytes:
+            key, entry = self._entries.popitem(last=False)
+            self._remove(key, entry)
+            _LOGGER.debug("Evict vod cache entry %s", entry['url'])
+
+    def lookup(self, url):
+        """Return the entry of url, with 'encoded' telling whether its AAC exists."""
+        with self._lock:
+            self._load()
+            key = cache_key(url)
+            entry = self._entries.get(key)
+            if entry is None or not os.path.exists(self.source_path(url)):
+                self._entries.pop(key, None)
+                return None
+            self._entries.move_to_end(key)
+            return dict(entry, encoded=os.path.exists(self.file_path(entry['clip'])))
+
+    def hit(self, url, etag=None, modified=None):
+        """The cached source is still current, refresh its validators."""
+        with self._lock:
+            entry = self._entries.get(cache_key(url))
+            if entry is None:
+                return
+            self.hits += 1
+            entry['etag'] = etag or entry['etag']
+            entry['modified'] = modified or entry['modified']
+            self._save()
+
+    def put(self, url, etag, modified, part, aac, duration=None):
+        """Move the downloaded part file and the AAC into the cache, return the clip key."""
+        with self._lock:
+            self._load()
+            self.misses += 1
+            key = cache_key(url)
+            old = self._entries.pop(key, None)
+            source = self.source_path(url)
+            # replaced in place, a source installed by an earlier put is never deleted
+            os.replace(part, source)
+            clip = file_hash(aac)
+            shutil.move(aac, self.file_path(clip))
+            self._entries[key] = {
+                'url': url,
+                'etag': etag,
+                'modified': modified,
+                'clip': clip,
+                'duration': duration,
+                'size': os.path.getsize(source) + os.path.getsize(self.file_path(clip)),
+            }
+            if old is not None and old['clip'] != clip:
+                self._remove_clip(old['clip'])
+            self._evict()
+            self._save()
+            return clip
+
+    def encoded(self, url, aac, duration=None):
+        """Store an AAC re-encoded from the cached source, return the clip key.
+
+        Returns None when the source was evicted meanwhile.
+        """
+        with self._lock:
+            entry = self._entries.get(cache_key(url))
+            if entry is None or not os.path.exists(self.source_path(url)):
+                return None
+            entry['clip'] = file_hash(aac)
+            entry['duration'] = duration
+            shutil.move(aac, self.file_path(entry['clip']))
+            entry['size'] = os.path.getsize(self.source_path(url)) + os.path.getsize(self.file_path(entry['clip']))
+            self._evict()
+            self._save()
+            return entry['clip']